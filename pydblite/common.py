@@ -4,6 +4,8 @@
 # Author : Bro <bro.development@gmail.com>
 #
 
+import re
+
 
 def enum(*sequential, **named):
     enums = dict(zip(sequential, range(len(sequential))), **named)
@@ -15,6 +17,10 @@ except:
     strinstance = str
 
 
+# characters with a special meaning in GLOB patterns
+_glob_escape = re.compile(r"([*?[])")
+
+
 def is_iterable_but_not_str(x):
     return hasattr(x, '__iter__') and not isinstance(x, strinstance)
 
@@ -31,21 +37,30 @@ class Expression(object):
                 self.filter_value = "'%%%s%%'" % self.value
             elif self.operator == Filter.operations.ILIKE:
                 self.filter_value = "'*%s*'" % self.value
+            elif self.operator == Filter.operations.STARTSWITH:
+                # GLOB is case sensitive, like str.startswith
+                self.filter_value = "'%s*'" % _glob_escape.sub(r"[\1]", self.value)
             elif self.operator == Filter.operations.IN:
-                self.filter_value = "('%s')" % "','".join(self.value)
+                self.filter_value = "('%s')" % "','".join(["%s" % v for v in self.value])
             else:
                 if type(self.value) is bool:
                     self.filter_value = 1 if self.value else 0
                 else:
                     self.filter_value = "'%s'" % self.value
 
+    def sql_operator(self):
+        """Returns the operator of the expression in SQL"""
+        if self.operator == Filter.operations.STARTSWITH:
+            return "GLOB"
+        return self.operator
+
     def filter_string(self):
-        filter_str = "%s %s %s" % (self.key, self.operator, self.filter_value)
+        filter_str = "%s %s %s" % (self.key, self.sql_operator(), self.filter_value)
         return filter_str
 
     def filter(self):
-        filter_str = "? %s ?" % (self.operator)
-        filter_values = (self.key, self.operator, self.filter_value)
+        filter_str = "? %s ?" % (self.sql_operator())
+        filter_values = (self.key, self.sql_operator(), self.filter_value)
         return filter_str, filter_values
 
     def __str__(self):
@@ -113,7 +128,8 @@ class Filter(object):
     Users should not have to use this class."""
     operations = enum(**{'AND': 'AND', 'OR': 'OR', 'LIKE': 'LIKE', 'ILIKE': "GLOB",
                          "IN": "IN", 'EQ': "=", 'NE': "!=", 'LT': "<", 'LE': "<=",
-                         'GT': ">", 'GE': ">="})
+                         'GT': ">", 'GE': ">=", 'STARTSWITH': "STARTSWITH",
+                         'REGEXP': "REGEXP"})
 
     def __init__(self, db, key):
         self.db = db
@@ -138,6 +154,16 @@ class Filter(object):
         """Perform ILIKE operation"""
         return self._comparison(value, self.operations.ILIKE)
 
+    def startswith(self, value):
+        """Perform STARTSWITH operation : the field starts with value (case
+        sensitive)"""
+        return self._comparison(value, self.operations.STARTSWITH)
+
+    def regex(self, pattern):
+        """Perform REGEXP operation : the regular expression pattern matches
+        the field (with re.search)"""
+        return self._comparison(pattern, self.operations.REGEXP)
+
     def __eq__(self, value):
         """Perform EQUALS operation
         When input value is an iterable, but not a string, it will match for
@@ -0,0 +1,559 @@
+# -*- coding: utf-8 -*-
+#
+# BSD licence
+#
+# Data structures of the indices of a pydblite base
+#
+# An index maps the values taken by a field to the sorted list of the ids of
+# the records whose field is equal to this value. A unique index maps each
+# value to the id of the only record with this value.
+#
+
+import binascii
+import bisect
+import itertools
+import numbers
+import re
+
+try:
+    string_types = basestring  # NOQA
+except NameError:
+    string_types = str
+
+
+class _Top(object):
+    """Object greater than any other object"""
+
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return self is other
+
+    def __gt__(self, other):
+        return self is not other
+
+    def __ge__(self, other):
+        return True
+
+    def __eq__(self, other):
+        return self is other
+
+    def __ne__(self, other):
+        return self is not other
+
+    __hash__ = object.__hash__
+
+
+_top = _Top()
+
+
+def sort_key(value):
+    """Returns the key used to sort value in an ordered index. Values of
+    different types (except numbers) can't be compared, so they are sorted
+    by type first. Tuples, used by the indices on several fields, are
+    sorted by the keys of their items"""
+    if value is None:
+        return (0,)
+    if isinstance(value, numbers.Real):
+        return (1, value)
+    if type(value) is tuple:
+        return (3, tuple([sort_key(v) for v in value]))
+    return (2, type(value).__name__, value)
+
+
+def merge(buckets):
+    """Returns the sorted list of the ids in several lists of sorted ids"""
+    buckets = list(buckets)
+    if len(buckets) == 1:
+        return list(buckets[0])
+    return sorted(itertools.chain.from_iterable(buckets))
+
+
+class HashIndex(dict):
+    """Index mapping the values of a field to the sorted list of the ids of
+    the records with this value"""
+
+    kind = "hash"
+    unique = False
+    # shallow copy of the index taken by snapshot()
+    _snapshot = None
+
+    def add(self, value, _id):
+        """Add _id to the ids of the records with value"""
+        ids = self._owned(value)
+        if ids is None:
+            self._new_key(value, [_id])
+        elif _id > ids[-1]:
+            ids.append(_id)
+        else:
+            bisect.insort(ids, _id)
+
+    def extend(self, value, ids):
+        """Add the sorted list ids to the ids of the records with value. The
+        ids must be greater than the ids already in the index"""
+        current = self._owned(value)
+        if current is None:
+            self._new_key(value, list(ids))
+        else:
+            current.extend(ids)
+
+    def add_many(self, value, ids):
+        """Add the sorted list ids to the ids of the records with value. The
+        list of ids is merged once"""
+        current = self._owned(value)
+        if current is None:
+            self._new_key(value, list(ids))
+        elif ids[0] > current[-1]:
+            current.extend(ids)
+        else:
+            # sorting two sorted runs is a merge
+            self[value] = sorted(current + ids)
+
+    def remove(self, value, _id):
+        """Remove _id from the ids of the records with value"""
+        self._owned(value)
+        ids = self[value]
+        pos = bisect.bisect(ids, _id) - 1
+        del ids[pos]
+        if not ids:
+            self._del_key(value)
+
+    def remove_many(self, value, ids):
+        """Remove the ids in the list ids from the ids of the records with
+        value. The list of ids is rebuilt once"""
+        if len(ids) == 1:
+            return self.remove(value, ids[0])
+        ids = set(ids)
+        kept = [_id for _id in self[value] if _id not in ids]
+        if kept:
+            self[value] = kept
+        else:
+            self._del_key(value)
+
+    def _new_key(self, value, ids):
+        self[value] = ids
+
+    def _del_key(self, value):
+        del self[value]
+
+    def _owned(self, value):
+        """Returns the ids of the records with value, or None. If they are
+        shared with a snapshot, they are copied first, so that they can be
+        changed in place"""
+        ids = self.get(value)
+        snapshot = self._snapshot
+        if snapshot is not None and ids is not None and \
+                snapshot.get(value) is ids:
+            ids = self[value] = type(ids)(ids)
+        return ids
+
+    def ids(self, value):
+        """Returns the sorted list of the ids of the records with value"""
+        return self.get(value, [])
+
+    def count(self, value):
+        """Returns the number of records with value"""
+        return len(self.ids(value))
+
+    def sorted_keys(self):
+        """Returns the values in the index, sorted if the index is ordered"""
+        return list(self.keys())
+
+    def prefix_ids(self, prefix):
+        """For an index on several fields, returns the sorted list of the ids
+        of the records whose values of the first fields are the items of the
+        tuple prefix"""
+        n = len(prefix)
+        return merge(self.ids(value) for value in self
+                     if value[:n] == prefix)
+
+    def matching_ids(self, test):
+        """Returns the sorted list of the ids of the records whose value
+        passes the function test. Each distinct value is only tested once"""
+        return merge(self.ids(value) for value in list(self) if test(value))
+
+    def startswith_ids(self, prefix):
+        """Returns the sorted list of the ids of the records whose value is
+        a string starting with prefix"""
+        return self.matching_ids(lambda value: isinstance(value, string_types)
+                                 and value.startswith(prefix))
+
+    def copy(self):
+        """Returns a copy of the index, with copies of the lists of ids"""
+        return self.__class__((value, list(ids))
+                              for (value, ids) in self.items())
+
+    def snapshot(self):
+        """Returns a shallow copy of the index, that shares the ids with the
+        index and is only meant to be pickled. Until release_snapshot() is
+        called, the ids shared with the copy are copied before they are
+        changed"""
+        snapshot = self.__class__.__new__(self.__class__)
+        dict.update(snapshot, self)
+        self._snapshot = snapshot
+        return snapshot
+
+    def release_snapshot(self):
+        """Stop copying the ids shared with the last snapshot"""
+        self._snapshot = None
+
+    def __reduce__(self):
+        # state rebuilt by __setstate__ is not pickled
+        return (self.__class__, (), {}, None, iter(self.items()))
+
+    def __setstate__(self, state):
+        pass
+
+
+class OrderedIndex(HashIndex):
+    """Index whose values are also kept sorted, so that the records with
+    a value in a range are found without reading the other records"""
+
+    kind = "ordered"
+
+    def __init__(self, *args, **kw):
+        HashIndex.__init__(self, *args, **kw)
+        self.__setstate__({})
+
+    def __setstate__(self, state):
+        # the sort keys of the values, sorted, and the values in the same
+        # order
+        self._values = sorted(self.keys(), key=sort_key)
+        self._keys = [sort_key(v) for v in self._values]
+
+    def _new_key(self, value, ids):
+        key = sort_key(value)
+        pos = bisect.bisect_left(self._keys, key)
+        self._keys.insert(pos, key)
+        self._values.insert(pos, value)
+        self[value] = ids
+
+    def _del_key(self, value):
+        pos = bisect.bisect_left(self._keys, sort_key(value))
+        del self._keys[pos]
+        del self._values[pos]
+        del self[value]
+
+    def sorted_keys(self):
+        return list(self._values)
+
+    def prefix_ids(self, prefix):
+        key = sort_key(prefix)
+        start = bisect.bisect_left(self._keys, key)
+        end = bisect.bisect_left(self._keys, (key[0], key[1] + (_top,)))
+        return merge(self.ids(v) for v in self._values[start:end])
+
+    def startswith_ids(self, prefix):
+        # the strings starting with prefix are sorted just after it
+        key = sort_key(prefix)
+        keys, values = self._keys, self._values
+        pos = bisect.bisect_left(keys, key)
+        buckets = []
+        while (pos < len(keys) and keys[pos][:2] == key[:2] and
+               values[pos].startswith(prefix)):
+            buckets.append(self.ids(values[pos]))
+            pos += 1
+        return merge(buckets)
+
+    def key_range(self, low=None, high=None, include_low=True,
+                  include_high=True):
+        """Returns the sorted list of the values in the index between low
+        and high. If low or high is None, the range is not bounded on this
+        side. Only values that can be compared with the bounds are
+        returned"""
+        keys = self._keys
+        start, end = 0, len(keys)
+        bounds = [sort_key(b) for b in (low, high) if b is not None]
+        if bounds:
+            # restrict to the values of the same type as the bounds
+            prefix = bounds[0][:-1]
+            if any(b[:-1] != prefix for b in bounds):
+                return []
+            start = bisect.bisect_left(keys, prefix)
+            end = bisect.bisect_left(keys, prefix + (_top,))
+        if low is not None:
+            key = sort_key(low)
+            if include_low:
+                start = max(start, bisect.bisect_left(keys, key))
+            else:
+                start = max(start, bisect.bisect_right(keys, key))
+        if high is not None:
+            key = sort_key(high)
+            if include_high:
+                end = min(end, bisect.bisect_right(keys, key))
+            else:
+                end = min(end, bisect.bisect_left(keys, key))
+        return self._values[start:end]
+
+    def ids_in_range(self, low=None, high=None, include_low=True,
+                     include_high=True):
+        """Returns the sorted list of the ids of the records whose value is
+        between low and high (see :meth:`key_range`)"""
+        values = self.key_range(low, high, include_low, include_high)
+        return merge(self.ids(v) for v in values)
+
+
+# positions of the bits set in each byte
+_bits = [tuple(i for i in range(8) if byte >> i & 1) for byte in range(256)]
+
+
+def bitmap_to_int(bitmap):
+    """Returns the integer whose bits are those of the bytearray bitmap (the
+    bit of id i is the bit i % 8 of the byte i // 8)"""
+    if not bitmap:
+        return 0
+    return int(binascii.hexlify(bytes(bitmap[::-1])), 16)
+
+
+def int_to_ids(bits):
+    """Returns the sorted list of the ids whose bit is set in the integer
+    bits"""
+    if not bits:
+        return []
+    hexa = "%x" % bits
+    if len(hexa) % 2:
+        hexa = "0" + hexa
+    bitmap = bytearray(binascii.unhexlify(hexa))[::-1]
+    ids = []
+    for (pos, byte) in enumerate(bitmap):
+        if byte:
+            base = pos * 8
+            ids.extend([base + i for i in _bits[byte]])
+    return ids
+
+
+def count_bits(bits):
+    """Returns the number of bits set in the integer bits"""
+    return bin(bits).count("1")
+
+
+class BitmapIndex(HashIndex):
+    """Index mapping the values of a field to a bitmap of the ids of the
+    records with this value : a bytearray where the bit of each id is set
+
+    Bitmaps use one bit per record of the base for each value, so they are
+    suited to fields with few distinct values. The filters combine the
+    bitmaps as integers, with bitwise operations, before reading the
+    records"""
+
+    kind = "bitmap"
+
+    def __init__(self, *args, **kw):
+        HashIndex.__init__(self)
+        for (value, ids) in dict(*args, **kw).items():
+            self.extend(value, ids)
+
+    def add(self, value, _id):
+        bitmap = self._owned(value)
+        if bitmap is None:
+            bitmap = self[value] = bytearray()
+        pos = _id >> 3
+        if pos >= len(bitmap):
+            bitmap.extend(bytearray(pos + 1 - len(bitmap)))
+        bitmap[pos] |= 1 << (_id & 7)
+
+    def extend(self, value, ids):
+        if not ids:
+            return
+        bitmap = self._owned(value)
+        if bitmap is None:
+            bitmap = self[value] = bytearray()
+        size = (max(ids) >> 3) + 1
+        if size > len(bitmap):
+            bitmap.extend(bytearray(size - len(bitmap)))
+        for _id in ids:
+            bitmap[_id >> 3] |= 1 << (_id & 7)
+
+    def add_many(self, value, ids):
+        self.extend(value, ids)
+
+    def remove(self, value, _id):
+        self._owned(value)
+        bitmap = self[value]
+        bitmap[_id >> 3] &= ~(1 << (_id & 7)) & 0xff
+        if not any(bitmap):
+            del self[value]
+
+    def remove_many(self, value, ids):
+        self._owned(value)
+        bitmap = self[value]
+        for _id in ids:
+            bitmap[_id >> 3] &= ~(1 << (_id & 7)) & 0xff
+        if not any(bitmap):
+            del self[value]
+
+    def bits(self, value):
+        """Returns the bitmap of the records with value, as an integer"""
+        bitmap = self.get(value)
+        return 0 if bitmap is None else bitmap_to_int(bitmap)
+
+    def all_bits(self):
+        """Returns the bitmap of all the records in the index"""
+        bits = 0
+        for value in self:
+            bits |= self.bits(value)
+        return bits
+
+    def ids(self, value):
+        return int_to_ids(self.bits(value))
+
+    def count(self, value):
+        return count_bits(self.bits(value))
+
+    def copy(self):
+        index = self.__class__()
+        for (value, bitmap) in self.items():
+            dict.__setitem__(index, value, bytearray(bitmap))
+        return index
+
+
+# words indexed by text indices
+_word = re.compile(r"\w+", re.UNICODE)
+
+
+def _trigrams(text):
+    """Returns the set of the substrings of length 3 of text"""
+    return set([text[i:i + 3] for i in range(len(text) - 2)])
+
+
+class TextIndex(HashIndex):
+    """Index on a field with text values. Besides the ids of the records
+    with each value, it maps the trigrams (substrings of 3 characters) and
+    the words of the values, in lower case, to the values where they are
+    found
+
+    The trigrams are used to find the values that may contain a string,
+    which are then tested : this is used by the operators LIKE and GLOB of
+    filters. The words are used by :meth:`search`"""
+
+    kind = "text"
+
+    def __init__(self, *args, **kw):
+        HashIndex.__init__(self, *args, **kw)
+        self.__setstate__({})
+
+    def __setstate__(self, state):
+        # trigram -> set of values, word -> set of values
+        self._trigrams = {}
+        self._words = {}
+        for value in self:
+            self._add_text(value)
+
+    def _add_text(self, value):
+        if not isinstance(value, string_types):
+            return
+        text = value.lower()
+        for trigram in _trigrams(text):
+            self._trigrams.setdefault(trigram, set()).add(value)
+        for word in set(_word.findall(text)):
+            self._words.setdefault(word, set()).add(value)
+
+    def _remove_text(self, value):
+        if not isinstance(value, string_types):
+            return
+        text = value.lower()
+        for (mapping, keys) in ((self._trigrams, _trigrams(text)),
+                                (self._words, set(_word.findall(text)))):
+            for key in keys:
+                values = mapping[key]
+                values.discard(value)
+                if not values:
+                    del mapping[key]
+
+    def _new_key(self, value, ids):
+        self[value] = ids
+        self._add_text(value)
+
+    def _del_key(self, value):
+        del self[value]
+        self._remove_text(value)
+
+    def _candidates(self, text):
+        """Returns the values that may contain text, in lower case"""
+        trigrams = _trigrams(text)
+        if not trigrams:
+            return [value for value in self
+                    if isinstance(value, string_types)]
+        sets = sorted([self._trigrams.get(t, set()) for t in trigrams],
+                      key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def like_ids(self, pattern):
+        """Returns the sorted list of the ids of the records whose value
+        contains pattern, ignoring case"""
+        text = pattern.lower()
+        return merge(self.ids(value) for value in self._candidates(text)
+                     if text in value.lower())
+
+    def contains_ids(self, pattern):
+        """Returns the sorted list of the ids of the records whose value
+        contains pattern"""
+        return merge(self.ids(value)
+                     for value in self._candidates(pattern.lower())
+                     if pattern in value)
+
+    def startswith_ids(self, prefix):
+        return merge(self.ids(value)
+                     for value in self._candidates(prefix.lower())
+                     if value.startswith(prefix))
+
+    def search(self, text):
+        """Returns the sorted list of the ids of the records whose value has
+        all the words of text, ignoring case"""
+        words = set(_word.findall(text.lower()))
+        if not words:
+            return []
+        sets = sorted([self._words.get(w, set()) for w in words], key=len)
+        return merge(self.ids(value)
+                     for value in sets[0].intersection(*sets[1:]))
+
+
+class _Unique(object):
+    """Base class of the unique indices, which map each value to the id of
+    the only record with this value"""
+
+    unique = True
+
+    def add(self, value, _id):
+        if value in self:
+            raise ValueError("Duplicate value {!r} in unique index".format(
+                value))
+        self._new_key(value, _id)
+
+    def extend(self, value, ids):
+        for _id in ids:
+            self.add(value, _id)
+
+    def add_many(self, value, ids):
+        self.extend(value, ids)
+
+    def remove(self, value, _id):
+        self._del_key(value)
+
+    def remove_many(self, value, ids):
+        for _id in ids:
+            self.remove(value, _id)
+
+    def ids(self, value):
+        _id = self.get(value)
+        return [] if _id is None else [_id]
+
+    def copy(self):
+        return self.__class__(self.items())
+
+
+class UniqueIndex(_Unique, HashIndex):
+    """Hash index on a field whose values are unique"""
+
+
+class UniqueOrderedIndex(_Unique, OrderedIndex):
+    """Ordered index on a field whose values are unique"""
+
+
+# classes of the indices, by kind
+kinds = {"hash": HashIndex, "ordered": OrderedIndex, "bitmap": BitmapIndex,
+         "text": TextIndex}
+
+# classes of the unique indices, by kind
+unique_kinds = {"hash": UniqueIndex, "ordered": UniqueOrderedIndex}
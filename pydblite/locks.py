@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+# BSD licence
+#
+# Locks used by the bases created with thread_safe=True, and by the
+# processes sharing a base file
+#
+# Several threads can read a base at the same time, a thread changing the
+# base has an exclusive access. The methods of the base are wrapped by the
+# decorators reader() and writer(), which use the attribute _lock of the
+# instance (None if the base is not thread safe).
+#
+# The processes reading a base file hold a shared lock on a lock file next
+# to it, the process writing it holds an exclusive lock (see FileLock).
+#
+
+import contextlib
+import functools
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class ReadWriteLock(object):
+    """Lock held by several readers or by a single writer
+
+    The locks are reentrant : a thread can acquire the read lock or the
+    write lock several times, and the thread holding the write lock can
+    also acquire the read lock. Threads waiting for the write lock have
+    priority over the new readers, so that writers are not starved"""
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        # number of read locks held by each thread
+        self._readers = {}
+        # thread holding the write lock, and number of times it holds it
+        self._writer = None
+        self._writes = 0
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        me = threading.current_thread()
+        with self._condition:
+            if self._writer is me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return
+            while self._writer is not None or self._waiting_writers:
+                self._condition.wait()
+            self._readers[me] = 1
+
+    def release_read(self):
+        me = threading.current_thread()
+        with self._condition:
+            count = self._readers[me] - 1
+            if count:
+                self._readers[me] = count
+            else:
+                del self._readers[me]
+                if not self._readers:
+                    self._condition.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread()
+        with self._condition:
+            if self._writer is me:
+                self._writes += 1
+                return
+            if me in self._readers:
+                # two readers waiting to write would wait for each other
+                raise RuntimeError("Can't change a base while reading it")
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._writes = 1
+
+    def release_write(self):
+        with self._condition:
+            self._writes -= 1
+            if not self._writes:
+                self._writer = None
+                self._condition.notify_all()
+
+
+def reader(method):
+    """Decorator of a method that reads the base : if the base is thread
+    safe, the method is called with the read lock"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kw):
+        lock = self._lock
+        if lock is None:
+            return method(self, *args, **kw)
+        lock.acquire_read()
+        try:
+            return method(self, *args, **kw)
+        finally:
+            lock.release_read()
+    return wrapper
+
+
+def writer(method):
+    """Decorator of a method that changes the base : if the base is thread
+    safe, the method is called with the write lock"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kw):
+        lock = self._lock
+        if lock is None:
+            return method(self, *args, **kw)
+        lock.acquire_write()
+        try:
+            return method(self, *args, **kw)
+        finally:
+            lock.release_write()
+    return wrapper
+
+
+class FileLock(object):
+    """Advisory lock (fcntl.flock) on a lock file, shared by the processes
+    reading a base file and exclusive for the process writing it. The base
+    file itself can't be locked, it is replaced when it is written
+
+    The lock file also stores a counter incremented by each write, used to
+    detect the changes made by other processes.
+
+    The lock is reentrant for each thread ; asking for the exclusive lock
+    while holding the shared lock converts it. Where fcntl is not available,
+    the lock file is used for the counter only
+
+    If the lock file can't be created, for a base in a read-only directory,
+    the shared lock is not held : the base is read without a lock, and the
+    counter is read in the lock file if it exists. The exclusive lock raises
+    IOError
+
+    Args:
+        - path (str): the path of the lock file, created if it doesn't
+          exist
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # file descriptor, number of acquisitions and mode for each thread
+        self._local = threading.local()
+
+    def acquire(self, exclusive=False):
+        local = self._local
+        if not getattr(local, "depth", 0):
+            local.fd, local.writable = self._open()
+            local.depth = 0
+            local.exclusive = False
+        if exclusive and not local.writable:
+            if local.depth == 0 and local.fd is not None:
+                os.close(local.fd)
+            raise IOError("Can't write the lock file {}".format(self.path))
+        if local.fd is not None and (local.depth == 0 or
+                                     (exclusive and not local.exclusive)):
+            if fcntl is not None:
+                try:
+                    fcntl.flock(local.fd, fcntl.LOCK_EX if exclusive
+                                else fcntl.LOCK_SH)
+                except Exception:
+                    if local.depth == 0:
+                        os.close(local.fd)
+                    raise
+            local.exclusive = exclusive
+        local.depth += 1
+
+    def _open(self):
+        """Returns a file descriptor of the lock file, or None if it can't be
+        opened, and True if the file can be written"""
+        try:
+            return os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666), True
+        except OSError:
+            pass
+        try:
+            # a shared lock can be held on a file opened for reading
+            return os.open(self.path, os.O_RDONLY), False
+        except OSError:
+            return None, False
+
+    def release(self):
+        local = self._local
+        local.depth -= 1
+        if not local.depth and local.fd is not None:
+            # closing the file releases the lock
+            os.close(local.fd)
+            local.fd = None
+
+    @contextlib.contextmanager
+    def locked(self, exclusive=False):
+        """Context manager holding the shared lock, or the exclusive lock
+        if exclusive is True"""
+        self.acquire(exclusive)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def counter(self):
+        """Returns the counter stored in the lock file. The lock must be
+        held. Returns 0 if the lock file can't be read"""
+        fd = self._local.fd
+        if fd is None:
+            return 0
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = os.read(fd, 32).strip()
+        return int(data) if data else 0
+
+    def increment(self):
+        """Increment the counter stored in the lock file and return it. The
+        exclusive lock must be held"""
+        counter = self.counter() + 1
+        fd = self._local.fd
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, str(counter).encode("ascii"))
+        return counter
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# BSD licence
+#
+# Parallel scans of the records of a pydblite base
+#
+# The worker processes are created by fork() when a scan starts, so they
+# share the records of the base with the calling process : records are
+# neither copied nor pickled, and the functions applied to them don't have
+# to be picklable. The ids of the records are split into chunks, a function
+# is applied to the records of each chunk in a worker process, and the
+# results, which must be picklable, are merged by the calling process.
+#
+
+import itertools
+import multiprocessing
+import os
+import threading
+
+# bases with fewer records are scanned by the calling process : starting
+# the worker processes would take longer than the scan
+MIN_RECORDS = 100000
+
+# number of chunks of ids for each worker process
+CHUNKS_PER_PROCESS = 4
+
+# the records, the list of their ids and the function of the current scan,
+# inherited by the worker processes
+_scan = None
+
+# held during a scan : the scans of several threads use _scan one after the
+# other
+_scan_lock = threading.Lock()
+
+
+def _pool(processes):
+    """Returns a pool of processes started by fork(), or None if fork() is
+    not available"""
+    if not hasattr(os, "fork"):
+        return None
+    try:
+        context = multiprocessing.get_context("fork")
+    except AttributeError:
+        # Python 2 always uses fork() where it is available
+        context = multiprocessing
+    return context.Pool(processes)
+
+
+def _run(chunk):
+    """Applies the function of the current scan to the records of the
+    chunk, in a worker process"""
+    records, ids, function = _scan
+    start, stop = chunk
+    return function(records[_id] for _id in ids[start:stop])
+
+
+def map_chunks(records, function, processes):
+    """Applies function to the records of each chunk of ids, in worker
+    processes
+
+    Args:
+        - records (dict): mapping between __id__ and the records
+        - function (callable): called with an iterator on the records of a
+          chunk, returns a picklable result
+        - processes (int): the number of worker processes
+
+    Returns:
+        - the list of the results for each chunk, in the order of the ids
+          in records. If fork() is not available, function is called once
+          for all the records, in the calling process
+
+    The scans started by several threads are run one after the other
+    """
+    global _scan
+    ids = list(records)
+    if not ids:
+        return []
+    size = -(-len(ids) // (processes * CHUNKS_PER_PROCESS))
+    chunks = [(start, start + size) for start in range(0, len(ids), size)]
+    with _scan_lock:
+        # set before the pool is created, to be inherited by the workers
+        _scan = (records, ids, function)
+        try:
+            pool = _pool(processes)
+            if pool is None:
+                return [function(records[_id] for _id in ids)]
+            try:
+                return pool.map(_run, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _scan = None
+
+
+def select(records, test, processes):
+    """Returns the list of the ids of the records that pass test, in the
+    order of the ids in records"""
+    def chunk_ids(chunk):
+        return [r["__id__"] for r in chunk if test(r)]
+    return list(itertools.chain.from_iterable(
+        map_chunks(records, chunk_ids, processes)))
+
+
+def count(records, test, processes):
+    """Returns the number of records that pass test"""
+    def chunk_count(chunk):
+        return sum(1 for r in chunk if test(r))
+    return sum(map_chunks(records, chunk_count, processes))
@@ -7,13 +7,34 @@
 #
 #
 
-import bisect
+import copy
+import datetime
+import heapq
 import operator
 import os
+import re
+import shutil
 import sys
-from itertools import groupby
+import threading
+import time
+from itertools import islice
 
-from .common import Expression, ExpressionGroup, Filter
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
+from . import parallel
+from . import storage
+from . import vectors
+from .common import Expression, ExpressionGroup, Filter, strinstance
+from .indices import BitmapIndex, HashIndex, OrderedIndex, TextIndex
+from .indices import merge, sort_key
+from .indices import count_bits, int_to_ids
+from .indices import kinds as index_kinds
+from .indices import unique_kinds as unique_index_kinds
+from .locks import FileLock, ReadWriteLock, reader, writer
+from .storage import check_supported as check_storage
 
 try:
     import cPickle as pickle
@@ -23,6 +44,124 @@ except:
 version = "3.0.5"
 
 
+def _replace(src, dst):
+    """Rename file src to dst, replacing dst if it exists"""
+    try:
+        os.replace(src, dst)
+    except AttributeError:  # Python 2
+        if os.name == "nt" and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+# types of the default values that can be shared by several records
+_immutable_types = set([type(None), bool, int, float, complex, str, bytes,
+                        frozenset, datetime.date, datetime.datetime,
+                        datetime.time, datetime.timedelta])
+if sys.version_info[0] == 2:
+    _immutable_types.update([unicode, long])  # NOQA
+
+
+def _immutable(value):
+    if type(value) is tuple:
+        return all(_immutable(v) for v in value)
+    return type(value) in _immutable_types
+
+
+def _copy_defaults(defaults):
+    """Returns a copy of the default values (a dict, or a list of values)
+    for a new record. The values are only deep-copied if some of them are
+    mutable"""
+    values = defaults.values() if isinstance(defaults, dict) else defaults
+    if all(_immutable(v) for v in values):
+        return type(defaults)(defaults)
+    return copy.deepcopy(defaults)
+
+
+def _index_value(record, key, changes=None):
+    """Returns the value of record in an index on key, a field name or a
+    tuple of field names for an index on several fields. If changes is
+    set, it maps fields to the values that replace those of record"""
+    if changes is None:
+        changes = {}
+    if isinstance(key, tuple):
+        return tuple([changes[f] if f in changes else record[f] for f in key])
+    return changes[key] if key in changes else record[key]
+
+
+def _index_fields(key):
+    """Returns the tuple of the fields of an index on key"""
+    return key if isinstance(key, tuple) else (key,)
+
+
+def _accept(record):
+    return True
+
+
+def _groups(records, group_by, aggregates):
+    """Returns a dictionary mapping the tuples of values of the group_by
+    fields in records to the list of the number of records and the values
+    of the aggregates (see :meth:`_Base.aggregate`)"""
+    groups = {}
+    for record in records:
+        key = tuple([record[field] for field in group_by])
+        values = groups.get(key)
+        if values is None:
+            values = groups[key] = [0] + [None] * len(aggregates)
+        values[0] += 1
+        for i, (func, field) in enumerate(aggregates, 1):
+            value = record[field]
+            if value is None:
+                continue
+            current = values[i]
+            if func == "avg":
+                if current is None:
+                    values[i] = [value, 1]
+                else:
+                    current[0] += value
+                    current[1] += 1
+            elif current is None:
+                values[i] = value
+            elif func == "sum":
+                values[i] = current + value
+            elif func == "min":
+                if value < current:
+                    values[i] = value
+            elif value > current:
+                values[i] = value
+    return groups
+
+
+def _merge_groups(parts, aggregates):
+    """Merge the dictionaries returned by :func:`_groups` for several sets
+    of records"""
+    groups = {}
+    for part in parts:
+        for (key, values) in part.items():
+            current = groups.get(key)
+            if current is None:
+                groups[key] = values
+                continue
+            current[0] += values[0]
+            for i, (func, _) in enumerate(aggregates, 1):
+                value = values[i]
+                if value is None:
+                    continue
+                if current[i] is None:
+                    current[i] = value
+                elif func == "avg":
+                    current[i] = [current[i][0] + value[0],
+                                  current[i][1] + value[1]]
+                elif func == "sum":
+                    current[i] += value
+                elif func == "min":
+                    if value < current[i]:
+                        current[i] = value
+                elif value > current[i]:
+                    current[i] = value
+    return groups
+
+
 def _in(a, b):
     return operator.contains(b, a)
 
@@ -31,6 +170,44 @@ def like(a, b):
     return operator.contains(a.lower(), b.lower())
 
 
+def startswith(a, b):
+    return isinstance(a, strinstance) and a.startswith(b)
+
+
+def regexp(a, b):
+    return isinstance(a, strinstance) and re.search(b, a) is not None
+
+
+def _compile(key, op, value, operation):
+    """Returns a function testing the value of key in a record with the
+    operator op, specialised for the most common operators"""
+    if op == "=":
+        return lambda r: r[key] == value
+    elif op == "!=":
+        return lambda r: r[key] != value
+    elif op == "<":
+        return lambda r: r[key] < value
+    elif op == "<=":
+        return lambda r: r[key] <= value
+    elif op == ">":
+        return lambda r: r[key] > value
+    elif op == ">=":
+        return lambda r: r[key] >= value
+    elif op == "IN":
+        return lambda r: r[key] in value
+    elif op == "LIKE":
+        lower = value.lower()
+        return lambda r: lower in r[key].lower()
+    elif op == "STARTSWITH":
+        return lambda r: startswith(r[key], value)
+    elif op == "REGEXP":
+        # the pattern is compiled once, not for each record
+        search = re.compile(value).search
+        return lambda r: (isinstance(r[key], strinstance) and
+                          search(r[key]) is not None)
+    return lambda r: operation(r[key], value)
+
+
 class PyDbExpression(Expression):
 
     def __init__(self, **kwargs):
@@ -39,37 +216,396 @@ class PyDbExpression(Expression):
                            "LIKE": like,
                            "GLOB": operator.contains,
                            "IN": _in,
+                           "STARTSWITH": startswith,
+                           "REGEXP": regexp,
                            "=": operator.eq, "!=": operator.ne,
                            "<": operator.lt, "<=": operator.le,
                            ">": operator.gt, ">=": operator.ge}
+        # the function built by compile()
+        self._test = None
 
     def apply(self, records):
-        operation = self.operations[self.operator]
-        records = [r for r in records if operation(r[self.key], self.value)]
-        return records
+        test = self.compile()
+        return [r for r in records if test(r)]
+
+    def compile(self):
+        """Returns a function that takes a record and returns True if it
+        matches the expression. The function is built once"""
+        if self._test is None:
+            self._test = _compile(self.key, self.operator, self.value,
+                                  self.operations[self.operator])
+        return self._test
+
+    def index_ids(self, db):
+        """Returns the sorted list of the ids of the records matching the
+        expression, found with an index of db, or None if no index of db can
+        be used"""
+        index = db.indices.get(self.key)
+        if index is None:
+            # an index on several fields whose first field is key
+            key, n = db._composite_index([self.key])
+            if n == 0 or self.operator not in ("=", "IN"):
+                return None
+            index = db.indices[key]
+            values = [self.value] if self.operator == "=" else self.value
+            try:
+                return merge(index.prefix_ids((v,)) for v in set(values))
+            except TypeError:
+                return None
+        if isinstance(index, TextIndex) and self.operator == "LIKE":
+            return index.like_ids(self.value)
+        elif isinstance(index, TextIndex) and self.operator == "GLOB":
+            return index.contains_ids(self.value)
+        elif self.operator == "STARTSWITH":
+            # a key range for an ordered index
+            return index.startswith_ids(self.value)
+        elif self.operator == "REGEXP":
+            # each distinct value is only tested once
+            search = re.compile(self.value).search
+            return index.matching_ids(lambda v: isinstance(v, strinstance) and
+                                      search(v) is not None)
+        try:
+            if self.operator == "=":
+                return list(index.ids(self.value))
+            elif self.operator == "IN":
+                return merge(index.ids(v) for v in set(self.value))
+        except TypeError:
+            # unhashable value
+            return None
+        if isinstance(index, OrderedIndex) and self.operator in _ranges:
+            return index.ids_in_range(*self.range())
+        return None
+
+    def range(self):
+        """For a range operator, returns the arguments low, high,
+        include_low, include_high of :meth:`OrderedIndex.ids_in_range`"""
+        is_low, include = _ranges[self.operator]
+        if is_low:
+            return (self.value, None, include, True)
+        return (None, self.value, True, include)
+
+
+# for range operators : True if the value is the low bound, and True if the
+# bound is included
+_ranges = {"<": (False, False), "<=": (False, True),
+           ">": (True, False), ">=": (True, True)}
+
+
+def _intersect(ids1, ids2):
+    """Returns the sorted list of ids in both sorted lists"""
+    if len(ids1) > len(ids2):
+        ids1, ids2 = ids2, ids1
+    ids1 = set(ids1)
+    return [_id for _id in ids2 if _id in ids1]
+
+
+def _union(ids1, ids2):
+    """Returns the sorted list of ids in one of the sorted lists"""
+    return sorted(set(ids1).union(ids2))
+
+
+def _iter_ids(records, ids):
+    """Returns an iterator on the records with the ids, skipping those
+    deleted while iterating"""
+    return (records[_id] for _id in ids if _id in records)
+
+
+def _combined_range(exp1, exp2):
+    """If exp1 and exp2 are range expressions on the same field, returns
+    the arguments of :meth:`OrderedIndex.ids_in_range` for the records
+    matching both, else None"""
+    if (exp1 is None or exp2 is None or exp1.key != exp2.key or
+            exp1.operator not in _ranges or exp2.operator not in _ranges):
+        return None
+    low, high, include_low, include_high = exp1.range()
+    low2, high2, include_low2, include_high2 = exp2.range()
+    if low is None:
+        low, include_low = low2, include_low2
+    elif low2 is not None:
+        return None
+    if high is None:
+        high, include_high = high2, include_high2
+    elif high2 is not None:
+        return None
+    return (low, high, include_low, include_high)
+
+
+# rank of the operators, from the one expected to match the fewest records
+_operator_ranks = {"=": 0, "IN": 1, "STARTSWITH": 2, "LIKE": 2, "GLOB": 2,
+                   "REGEXP": 3, "<": 3, "<=": 3, ">": 3, ">=": 3, "!=": 4}
+
+
+def _selectivity(exp_group):
+    """Estimate of the proportion of records matching an expression group,
+    used to evaluate the most selective expression first : the lower the
+    better"""
+    if exp_group.expression:
+        return _operator_ranks.get(exp_group.expression.operator, 4)
+    ranks = (_selectivity(exp_group.exp_group1),
+             _selectivity(exp_group.exp_group2))
+    if exp_group.exp_operator == Filter.operations.AND:
+        return min(ranks)
+    return max(ranks)
 
 
 class PyDbExpressionGroup(ExpressionGroup):
 
-    def apply_filter(self, records):
+    def __init__(self):
+        super(PyDbExpressionGroup, self).__init__()
+        # the function built by compile(), and what it was built from
+        self._compiled = None
+
+    def apply_filter(self, records, db=None):
         if self.is_dummy():
             return ""
+        return list(self.iter_filter(records, db))
+
+    def iter_filter(self, records, db=None):
+        """Returns an iterator on the records matching the expression group,
+        sorted by __id__. The records are found when the iterator is
+        consumed ; the records deleted meanwhile are skipped, so the loop
+        consuming the iterator can change the base"""
+        if self.is_dummy():
+            return _iter_ids(records, list(records))
+        if db is not None:
+            ids = self.index_ids(db)
+            if ids is not None:
+                return _iter_ids(records, ids)
+        # test each record once with the function for the whole tree
+        test = self.compile()
+        if db is not None and db._parallel(records):
+            ids = parallel.select(records, test, db.processes)
+            return _iter_ids(records, ids)
+        return (r for r in _iter_ids(records, list(records)) if test(r))
+
+    def count(self, records, db=None):
+        """Returns the number of records matching the expression group,
+        without building the list of these records"""
+        if self.is_dummy():
+            return len(records)
+        if db is not None:
+            bits = self.bitmap(db)
+            if bits is not None:
+                return count_bits(bits)
+            mask = self.mask(db)
+            if mask is not None:
+                return db._vectors.count(mask)
+            ids = self.index_ids(db)
+            if ids is not None:
+                return len(ids)
+        test = self.compile()
+        if db is not None and db._parallel(records):
+            return parallel.count(records, test, db.processes)
+        return sum(1 for r in records.values() if test(r))
+
+    def compile(self):
+        """Returns a function that takes a record and returns True if it
+        matches the expression group
+
+        The function is built once, by composing the functions of the
+        expressions, and rebuilt if the group or one of its sub-groups is
+        changed. For AND, the most selective expression is tested first."""
+        if self.is_dummy():
+            return lambda r: True
         if self.expression:
-            return self.expression.apply(records.values())
+            source = (self.expression,)
         else:
-            # Parent of two expressions
-            records1 = self.exp_group1.apply_filter(records)
-            records2 = self.exp_group2.apply_filter(records)
-            if self.exp_operator == Filter.operations.AND:
-                ids1 = dict([(id(r), r) for r in records1])
-                ids2 = dict([(id(r), r) for r in records2])
-                ids = set(ids1.keys()) & set(ids2.keys())
-                records = [ids1[_id] for _id in ids]
+            source = (self.exp_operator, self.exp_group1.compile(),
+                      self.exp_group2.compile())
+        if self._compiled is None or self._compiled[0] != source:
+            if self.expression:
+                test = self.expression.compile()
+            elif self.exp_operator == Filter.operations.AND:
+                test1, test2 = source[1:]
+                if _selectivity(self.exp_group2) < \
+                        _selectivity(self.exp_group1):
+                    test1, test2 = test2, test1
+                test = lambda r: test1(r) and test2(r)  # noqa
             else:
-                ids = dict([(id(r), r) for r in records1])
-                ids.update(dict([(id(r), r) for r in records2]))
-                records = ids.values()
-            return records
+                test1, test2 = source[1:]
+                test = lambda r: test1(r) or test2(r)  # noqa
+            self._compiled = (source, test)
+        return self._compiled[1]
+
+    def index_ids(self, db):
+        """Returns the sorted list of the ids of the records matching the
+        filter, found with the indices of db, or None if the indices can't
+        be used
+
+        The ids sets of the expressions that can use an index are
+        intersected (for AND) or merged (for OR). For AND, if only one of the
+        expressions can use an index, the other one is only tested on the
+        records found by the index.
+
+        If all the expressions use bitmap indices, the bitmaps are combined
+        first (see :meth:`bitmap`). If the base keeps arrays of the values
+        of its fields, they are used for the fields without index (see
+        :meth:`mask`)."""
+        bits = self.bitmap(db)
+        if bits is not None:
+            return int_to_ids(bits)
+        mask = self.mask(db)
+        if mask is not None:
+            return db._vectors.ids_of(mask)
+        if self.expression:
+            return self.expression.index_ids(db)
+        if self.exp_operator == Filter.operations.AND:
+            ids = self._composite_ids(db)
+            if ids is not None:
+                return ids
+            bounds = _combined_range(self.exp_group1.expression,
+                                     self.exp_group2.expression)
+            if bounds is not None:
+                index = db.indices.get(self.exp_group1.expression.key)
+                if isinstance(index, OrderedIndex):
+                    # range with both bounds
+                    return index.ids_in_range(*bounds)
+        ids1 = self.exp_group1.index_ids(db)
+        if self.exp_operator == Filter.operations.AND:
+            if ids1 == []:
+                return []
+            ids2 = self.exp_group2.index_ids(db)
+            if ids1 is None and ids2 is None:
+                return None
+            elif ids1 is not None and ids2 is not None:
+                return _intersect(ids1, ids2)
+            # test the other expression on the records found by the index
+            ids, other = ((ids1, self.exp_group2) if ids2 is None
+                          else (ids2, self.exp_group1))
+            test = other.compile()
+            return [_id for _id in ids if test(db.records[_id])]
+        if ids1 is None:
+            return None
+        ids2 = self.exp_group2.index_ids(db)
+        if ids2 is None:
+            return None
+        return _union(ids1, ids2)
+
+    def _uses_bitmaps(self, db):
+        """True if all the expressions of the group can use a bitmap
+        index"""
+        if self.expression:
+            return (self.expression.operator in ("=", "IN", "!=") and
+                    isinstance(db.indices.get(self.expression.key),
+                               BitmapIndex))
+        return (self.exp_group1._uses_bitmaps(db) and
+                self.exp_group2._uses_bitmaps(db))
+
+    def bitmap(self, db):
+        """If all the expressions of the group use bitmap indices, returns
+        the bitmap of the matching records, as an integer, else None
+
+        The bitmaps of the values are combined with & for AND and | for OR.
+        For !=, the bitmap of the value is removed from the bitmap of all
+        the records"""
+        if self.is_dummy() or not self._uses_bitmaps(db):
+            return None
+        try:
+            return self._bitmap(db)
+        except TypeError:
+            # unhashable value
+            return None
+
+    def _bitmap(self, db):
+        if self.expression:
+            exp = self.expression
+            index = db.indices[exp.key]
+            if exp.operator == "=":
+                return index.bits(exp.value)
+            elif exp.operator == "!=":
+                return index.all_bits() & ~index.bits(exp.value)
+            bits = 0
+            for value in set(exp.value):
+                bits |= index.bits(value)
+            return bits
+        bits1 = self.exp_group1._bitmap(db)
+        if self.exp_operator == Filter.operations.AND:
+            if not bits1:
+                return 0
+            return bits1 & self.exp_group2._bitmap(db)
+        return bits1 | self.exp_group2._bitmap(db)
+
+    def mask(self, db):
+        """If db keeps NumPy arrays of the values of its fields
+        (``vectorize=True``), no field of the group has an index and all the
+        expressions can use the arrays, returns the array of booleans set
+        for the matching records, else None
+
+        The masks of the expressions are combined with & for AND and | for
+        OR"""
+        if (db._vectors is None or self.is_dummy() or
+                self._uses_indices(db)):
+            return None
+        return self._mask(db)
+
+    def _uses_indices(self, db):
+        """True if one of the expressions of the group is on a field with
+        an index"""
+        if self.expression:
+            return self.expression.key in db.indices
+        return (self.exp_group1._uses_indices(db) or
+                self.exp_group2._uses_indices(db))
+
+    def _mask(self, db):
+        if self.expression:
+            exp = self.expression
+            if exp.key not in db.fields:
+                return None
+            return db._vectors.mask(exp.key, exp.operator, exp.value,
+                                    db.records)
+        mask1 = self.exp_group1._mask(db)
+        if mask1 is None:
+            return None
+        mask2 = self.exp_group2._mask(db)
+        if mask2 is None:
+            return None
+        if self.exp_operator == Filter.operations.AND:
+            return mask1 & mask2
+        return mask1 | mask2
+
+    def _conjuncts(self):
+        """Returns the list of the expression groups combined by AND in
+        this group"""
+        if self.exp_operator == Filter.operations.AND:
+            return (self.exp_group1._conjuncts() +
+                    self.exp_group2._conjuncts())
+        return [self]
+
+    def _composite_ids(self, db):
+        """If the group combines with AND equalities on the first fields of
+        an index on several fields, returns the sorted list of the ids of the
+        matching records found with this index, else None"""
+        conjuncts = self._conjuncts()
+        equalities = dict((group.expression.key, group)
+                          for group in conjuncts
+                          if group.expression is not None and
+                          group.expression.operator == "=")
+        key, n = db._composite_index(equalities)
+        if n < 2:
+            return None
+        used = [equalities[f] for f in key[:n]]
+        value = tuple([group.expression.value for group in used])
+        index = db.indices[key]
+        try:
+            ids = list(index.ids(value) if n == len(key)
+                       else index.prefix_ids(value))
+        except TypeError:
+            # unhashable value
+            return None
+        # the other expressions use their indices, or are tested on the
+        # records found
+        tests = []
+        for group in conjuncts:
+            if any(group is u for u in used):
+                continue
+            group_ids = group.index_ids(db)
+            if group_ids is None:
+                tests.append(group.compile())
+            else:
+                ids = _intersect(ids, group_ids)
+        for test in tests:
+            ids = [_id for _id in ids if test(db.records[_id])]
+        return ids
 
 
 class PyDbFilter(Filter):
@@ -80,8 +616,183 @@ class PyDbFilter(Filter):
         self.expression_group = PyDbExpressionGroup()
         self.expression_t = PyDbExpression
 
+        # set by order_by(), offset() and limit()
+        self._order = None
+        self._offset = 0
+        self._limit = None
+
+    @property
+    def _lock(self):
+        # lock of the base, used by the decorator reader()
+        return self.db._lock
+
     def apply_filter(self, records):
-        return self.expression_group.apply_filter(records)
+        return self.expression_group.apply_filter(records, self.db)
+
+    def order_by(self, field, desc=False):
+        """Sort the records by the value of field, in descending order if
+        desc is True. Records with the same value are sorted by __id__"""
+        if field != "__id__" and field not in self.db.fields:
+            raise ValueError("{} is not a field".format(field))
+        self._order = (field, desc)
+        return self
+
+    def offset(self, offset):
+        """Skip the first offset records matching the filter"""
+        self._offset = offset
+        return self
+
+    def limit(self, limit):
+        """Return at most limit records"""
+        self._limit = limit
+        return self
+
+    def first(self):
+        """Returns the first record matching the filter, or None"""
+        for record in self:
+            return record
+        return None
+
+    @reader
+    def __iter__(self):
+        """Returns an iterator on the records matching the filter. The
+        records are not stored in a list : they are found while iterating,
+        except for a thread safe base, where they are all found when the
+        iteration starts (snapshot)"""
+        if self._order is None:
+            records = self.expression_group.iter_filter(self.db.records,
+                                                        self.db)
+        else:
+            records = self._sorted()
+        if self._offset or self._limit is not None:
+            stop = None if self._limit is None else self._offset + self._limit
+            records = islice(records, self._offset, stop)
+        if self.db._lock is not None:
+            # found while the base is locked
+            return iter(list(records))
+        return records
+
+    def _sorted(self):
+        """Returns an iterator on the records matching the filter, in the
+        order set by order_by()"""
+        field, desc = self._order
+        index = self.db.indices.get(field)
+        if isinstance(index, OrderedIndex):
+            return self._walk_index(index, desc)
+        records = self.expression_group.iter_filter(self.db.records, self.db)
+        key = lambda r: sort_key(r[field])  # noqa
+        if self._limit is None:
+            records = sorted(records, key=key, reverse=desc)
+        else:
+            # only keep the first records
+            select = heapq.nlargest if desc else heapq.nsmallest
+            records = select(self._offset + self._limit, records, key=key)
+        return _iter_ids(self.db.records, [r["__id__"] for r in records])
+
+    def _walk_index(self, index, desc):
+        """Generator of the records matching the filter, sorted by the
+        values of the ordered index"""
+        group = self.expression_group
+        ids = test = None
+        if not group.is_dummy():
+            ids = group.index_ids(self.db)
+            if ids is None:
+                test = group.compile()
+            else:
+                ids = set(ids)
+        values = index.sorted_keys()
+        if desc:
+            values.reverse()
+        records = self.db.records
+        for value in values:
+            for _id in list(index.ids(value)):
+                if (ids is not None and _id not in ids) or _id not in records:
+                    continue
+                record = records[_id]
+                if test is None or test(record):
+                    yield record
+
+    @reader
+    def __len__(self):
+        """Returns the number of records that matches this filter"""
+        count = self.expression_group.count(self.db.records, self.db)
+        count = max(count - self._offset, 0)
+        if self._limit is not None:
+            count = min(count, self._limit)
+        return count
+
+
+class Record(list):
+    """Record of a base created with compact_records=True
+
+    The values are stored in a list, in the order given by a layout (a
+    dictionary mapping the field names to their position) shared by all
+    the records of the base. Records are accessed like dictionaries :
+    record['field']"""
+
+    __slots__ = ("_layout",)
+
+    def __init__(self, layout, values):
+        list.__init__(self, values)
+        self._layout = layout
+
+    def __reduce__(self):
+        return (Record, (self._layout, self.values()))
+
+    def __getitem__(self, key):
+        return list.__getitem__(self, self._layout[key])
+
+    def __setitem__(self, key, value):
+        list.__setitem__(self, self._layout[key], value)
+
+    def __delitem__(self, key):
+        raise TypeError("Fields are removed from records by drop_field()")
+
+    def __contains__(self, key):
+        return key in self._layout
+
+    def __iter__(self):
+        return iter(self._layout)
+
+    def __eq__(self, other):
+        if isinstance(other, Record) and other._layout is self._layout:
+            return list.__eq__(self, other)
+        if isinstance(other, (dict, Record)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def copy(self):
+        return Record(self._layout, self.values())
+
+    def get(self, key, default=None):
+        pos = self._layout.get(key)
+        return default if pos is None else list.__getitem__(self, pos)
+
+    def items(self):
+        return [(k, list.__getitem__(self, pos))
+                for (k, pos) in self._layout.items()]
+
+    def keys(self):
+        return list(self._layout)
+
+    def update(self, values):
+        for (k, v) in values.items():
+            self[k] = v
+
+    def values(self):
+        return list(list.__iter__(self))
+
+
+Mapping.register(Record)
 
 
 class Index(object):
@@ -92,26 +803,110 @@ class Index(object):
         self.db = db  # database object (instance of Base)
         self.field = field  # field name
 
+    @property
+    def _lock(self):
+        # lock of the base, used by the decorator reader()
+        return self.db._lock
+
     def __iter__(self):
-        return iter(self.db.indices[self.field])
+        return iter(self.keys())
 
+    @reader
     def keys(self):
-        return self.db.indices[self.field].keys()
+        """Returns the values taken by the field, sorted if the index is
+        ordered"""
+        return self.db.indices[self.field].sorted_keys()
 
+    @reader
     def __getitem__(self, key):
         """Lookup by key : return the list of records where
         field value is equal to this key, or an empty list"""
-        ids = self.db.indices[self.field].get(key, [])
+        ids = self.db.indices[self.field].ids(key)
         return [self.db.records[_id] for _id in ids]
 
+    @reader
+    def range(self, low=None, high=None, include_low=True,
+              include_high=True):
+        """Returns the list of records where the field value is between
+        low and high, sorted by this value. If low or high is None, the
+        range is not bounded on this side. Only available for ordered
+        indices"""
+        index = self.db.indices[self.field]
+        if not isinstance(index, OrderedIndex):
+            raise TypeError("Index on {} is not ordered".format(self.field))
+        records = []
+        for value in index.key_range(low, high, include_low, include_high):
+            records.extend([self.db.records[_id]
+                            for _id in index.ids(value)])
+        return records
+
+    @reader
+    def search(self, text):
+        """Returns the list of records where the field value has all the
+        words of text, ignoring case. Only available for text indices"""
+        index = self.db.indices[self.field]
+        if not isinstance(index, TextIndex):
+            raise TypeError("Index on {} is not a text index".format(
+                self.field))
+        return [self.db.records[_id] for _id in index.search(text)]
+
 
 class _Base(object):
 
     def __init__(self, path, protocol=pickle.HIGHEST_PROTOCOL,
-            save_to_file=True, sqlite_compat=False):
+            save_to_file=True, sqlite_compat=False, journal=False,
+            commit_every=None, commit_interval=None, storage=None,
+            cache_size=None, compact_records=False, vectorize=False,
+            processes=None, thread_safe=False):
         """protocol as defined in pickle / pickle.
         Defaults to the highest protocol available.
         For maximum compatibility use protocol = 0.
+
+        If journal is True, commit() appends the changes made since the
+        previous commit to a journal file (path + "-journal") instead of
+        rewriting the whole base. The journal is replayed by open() and
+        merged into the base file by compact().
+
+        commit_every and commit_interval set autocommit thresholds : a
+        background commit is started after this number of changes, or at
+        the first change made after this number of seconds since the
+        previous commit.
+
+        storage is the format used to write the base file : "pickle" to
+        store the records in the base file, or "columnar" to store each
+        field in a separate file, opened with mmap (see
+        :mod:`pydblite.storage`). Records of a base stored in columns are only
+        loaded in memory when they are accessed. If not specified, the
+        format of the existing base file is kept, and "pickle" is used for
+        new bases. Column storage requires Python 3.
+
+        cache_size is the maximum number of unchanged records kept in memory
+        for a base stored in columns ; the least recently used records are
+        removed from memory first. If None, the records are kept in memory
+        once they have been read.
+
+        If compact_records is True, records are instances of
+        :class:`Record` instead of dictionaries : the values are stored in a
+        list, which uses less memory.
+
+        If vectorize is True, the values of the fields whose values are all
+        numbers (or None) are also kept in NumPy arrays, built the first
+        time they are needed. The filters on these fields, and the counts of
+        get_group_count(), are then computed with operations on arrays
+        instead of a test on each record. Requires NumPy.
+
+        processes is the number of worker processes used to scan the records
+        of a large base, for the filters and aggregates that can't use an
+        index (see :mod:`pydblite.parallel`). If None, the records are
+        scanned by the calling process.
+
+        If thread_safe is True, the base can be shared by several threads :
+        the methods that read the base can run at the same time in several
+        threads, a method that changes the base runs alone (see
+        :class:`ReadWriteLock <pydblite.locks.ReadWriteLock>`). Iteration
+        on the base and on filters returns the records found when the
+        iteration starts, and update() replaces the records by updated
+        copies, so that the records already returned are not changed.
         """
         # Path of the database in the file system.
         self.path = path
@@ -123,6 +918,51 @@ class _Base(object):
             save_to_file = False
         self.save_to_file = save_to_file
         self.sqlite_compat = sqlite_compat
+        if storage not in (None, "pickle", "columnar"):
+            raise ValueError("Invalid storage : '{}'".format(storage))
+        if storage == "columnar":
+            # the argument hides the module storage
+            check_storage()
+        self.storage = storage
+        self.cache_size = cache_size
+        self.compact_records = compact_records
+        if vectorize and vectors.numpy is None:
+            raise ImportError("vectorize=True requires NumPy")
+        # arrays of the values of the numeric fields, if vectorize is True
+        self._vectors = vectors.Vectors() if vectorize else None
+        self.processes = processes
+        # lock used by the decorators reader() and writer()
+        self._lock = ReadWriteLock() if thread_safe else None
+        # lock shared with the other processes using the base file, and
+        # state of the files when this instance last read or wrote them
+        self._file_lock = FileLock(path + ".lock")
+        self._file_state = None
+        # position of the end of the changes read from the journal
+        self._journal_end = 0
+        # positions of the values in compact records
+        self._layout = None
+        # Path of the journal file, used if journal is True
+        self.journal_path = path + "-journal"
+        self.journal = journal and save_to_file
+        # Serialized changes not yet written to the journal. Set to None when
+        # changes must not be journaled.
+        self._changes = [] if self.journal else None
+        # Generation of the base file, incremented by each compact(). The
+        # journal is only replayed on top of the generation it was started on
+        self._generation = 0
+        self._replaying = False
+        # Autocommit thresholds, and state of the changes since last commit
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._uncommitted = 0
+        self._last_commit = time.time()
+        # Thread writing the base file started by commit(background=True),
+        # and the exception that made it fail
+        self._commit_thread = None
+        self._commit_error = None
+        # Records written by the background commit in progress, by id. A
+        # record shared with this snapshot is copied before it is changed
+        self._snapshot = None
         # List of the fields (does not include the internal fields __id__ and
         # __version__).
         self.fields = []
@@ -139,6 +979,7 @@ class _Base(object):
         """
         return os.path.isfile(self.path)
 
+    @writer
     def create(self, *fields, **kw):
         """
         Create a new base with specified field names.
@@ -183,10 +1024,16 @@ class _Base(object):
         self.records = {}
         self.next_id = 0
         self.indices = {}
-        self.commit()
+        # the existing base file is replaced
+        self._file_state = None
+        self._layout = self._make_layout()
+        if self._vectors is not None:
+            self._vectors.clear()
+        self.compact()
         return self
 
-    def create_index(self, *fields):
+    @writer
+    def create_index(self, *fields, **kw):
         """
         Create an index on the specified field names
 
@@ -198,39 +1045,142 @@ class _Base(object):
         of the class Index (see above). Its name it the field name, with the
         prefix _ to avoid name conflicts
 
+        A tuple of field names creates an index on several fields, whose
+        values are the tuples of the values of these fields. It is used by
+        selections on all these fields, or on the first ones. The name of
+        the attribute is made of the field names joined by _
+
         Args:
-            - fields (list): the fields to index
+            - fields (list): the fields to index, or tuples of fields
+            - kind (str): the kind of index : "hash" (the default value),
+              or "ordered" for an index that also keeps the values sorted,
+              used to select the records with a value in a range
+            - unique (bool): if True, the values of the field must be
+              unique : the index maps each value to a single id, and
+              insert() and update() raise ValueError for a duplicate value
+
+        Raises:
+            - ValueError if unique is True and the records don't have
+              unique values
         """
-        reset = False
+        kind = kw.get("kind", "hash")
+        unique = kw.get("unique", False)
+        if kind not in index_kinds:
+            raise ValueError("Invalid kind of index : '{}'".format(kind))
+        if unique and kind not in unique_index_kinds:
+            raise ValueError("Index of kind '{}' can't be unique".format(
+                kind))
+        indices = {}
         for f in fields:
-            if f not in self.fields:
-                raise NameError("{} is not a field name {}".format(f,
-                    self.fields))
+            if isinstance(f, list):
+                f = tuple(f)
+            if isinstance(f, tuple) and len(f) == 1:
+                f = f[0]
+            for field in _index_fields(f):
+                if field not in self.fields:
+                    raise NameError("{} is not a field name {}".format(
+                        field, self.fields))
             # initialize the indices
-            if self.mode == "open" and f in self.indices:
+            if (self.mode == "open" and f in self.indices and
+                    self.indices[f].kind == kind and
+                    self.indices[f].unique == unique):
                 continue
-            reset = True
-            self.indices[f] = {}
+            buckets = {}
             for _id, record in self.records.items():
-                # use bisect to quickly insert the id in the list
-                bisect.insort(self.indices[f].setdefault(record[f], []), _id)
+                buckets.setdefault(_index_value(record, f), []).append(_id)
+            if unique:
+                for (value, ids) in buckets.items():
+                    if len(ids) > 1:
+                        raise ValueError("Duplicate value {!r} for unique "
+                                         "index on {}".format(value, f))
+                indices[f] = unique_index_kinds[kind](
+                    (value, ids[0]) for (value, ids) in buckets.items())
+            else:
+                for ids in buckets.values():
+                    ids.sort()
+                indices[f] = index_kinds[kind](buckets)
+        for (f, index) in indices.items():
+            self.indices[f] = index
             # create a new attribute of self, used to find the records
             # by this index
-            setattr(self, "_" + f, Index(self, f))
-        if reset:
-            self.commit()
+            setattr(self, "_" + "_".join(_index_fields(f)), Index(self, f))
+        if indices:
+            self.compact()
 
+    @writer
     def delete_index(self, *fields):
-        """Delete the index on the specified fields"""
+        """Delete the index on the specified fields (a field name, or a tuple
+        of field names for an index on several fields)"""
+        fields = [tuple(f) if isinstance(f, list) else f for f in fields]
         for f in fields:
             if f not in self.indices:
                 raise ValueError("No index on field {}".format(f))
         for f in fields:
             del self.indices[f]
-        self.commit()
-
+        self.compact()
+
+    def _check_unique(self, changes):
+        """Raise ValueError if records have the same value as another record
+        for a unique index. changes is a list of (record, values), where
+        values is a dictionary with the new values of some fields of the
+        record, or None for a new record"""
+        for (key, index) in self.indices.items():
+            if not index.unique:
+                continue
+            fields = set(_index_fields(key))
+            changed = [(record, values) for (record, values) in changes
+                       if values is None or not fields.isdisjoint(values)]
+            ids = set([record["__id__"] for (record, _) in changed])
+            values = set()
+            for (record, new_values) in changed:
+                value = _index_value(record, key, new_values)
+                owner = index.get(value)
+                if value in values or (owner is not None and
+                                       owner not in ids):
+                    raise ValueError("Duplicate value {!r} for unique "
+                                     "index on {}".format(value, key))
+                values.add(value)
+
+    @reader
+    def get_by(self, field, value):
+        """Returns the record whose value of field is value, or None. field
+        must have a unique index (field can be a tuple of fields for an
+        index on several fields, value is then a tuple)"""
+        if isinstance(field, list):
+            field = tuple(field)
+        index = self.indices.get(field)
+        if index is None or not index.unique:
+            raise ValueError("No unique index on field {}".format(field))
+        _id = index.get(value)
+        return None if _id is None else self.records[_id]
+
+    def _composite_index(self, fields):
+        """Returns the key of the index on several fields whose longest
+        sequence of first fields are in fields, and the length of this
+        sequence. Returns (None, 0) if there is no such index"""
+        best, best_n = None, 0
+        for key in self.indices:
+            if not isinstance(key, tuple):
+                continue
+            n = 0
+            while n < len(key) and key[n] in fields:
+                n += 1
+            if n > best_n:
+                best, best_n = key, n
+        return best, best_n
+
+    @writer
     def open(self):
         """Open an existing database and load its content into memory"""
+        # wait until a background commit has written the base file
+        self.wait_commit()
+        # other processes can't write the base file while it is read
+        with self._file_lock.locked():
+            self._open()
+            self._file_state = self._file_signature()
+        return self
+
+    def _open(self):
         # guess protocol
         mode = "r" if self.protocol == 0 else "rb"
         with open(self.path, mode) as _in:
@@ -243,22 +1193,438 @@ class _Base(object):
                 self.default_values = pickle.load(_in)
             except EOFError:
                 self.default_values = {}
+            try:
+                self._generation = pickle.load(_in)
+            except EOFError:
+                self._generation = 0
+            for (f, index) in self.indices.items():
+                if type(index) is dict:
+                    # index saved by a previous version
+                    self.indices[f] = HashIndex(index)
+            if self._vectors is not None:
+                self._vectors.clear()
+            self._layout = self._make_layout()
+            if isinstance(self.records, storage.ColumnsHeader):
+                header, self.records = self.records, None
+                self._open_columns(header)
+                if self.storage is None:
+                    self.storage = "columnar"
+            else:
+                self._convert_records()
             for f in self.indices.keys():
-                setattr(self, "_" + f, Index(self, f))
+                setattr(self, "_" + "_".join(_index_fields(f)),
+                        Index(self, f))
         self.mode = "open"
-        return self
+        self._replay_journal()
 
-    def commit(self):
-        """Write the database to a file"""
+    @writer
+    def refresh(self):
+        """Reload the base if another process has written the base file or
+        its journal since this instance read or wrote it. If the other
+        process only appended changes to the journal, these changes are
+        applied to the base in memory, else the base is opened again.
+        Changes that are not committed are discarded
+
+        Returns:
+            - bool: True if the base was reloaded
+        """
+        if not self.save_to_file:
+            return False
+        self.wait_commit()
+        with self._file_lock.locked():
+            state = self._file_signature()
+            if state == self._file_state:
+                return False
+            previous = self._file_state
+            if (previous is not None and not self._uncommitted and
+                    previous[1] == state[1] and state[2] is not None and
+                    (previous[2] is None or previous[2][0] == state[2][0]) and
+                    not os.path.isfile(self.journal_path + "-old")):
+                # same base file, changes appended to the journal
+                start = None if previous[2] is None else self._journal_end
+                self._replaying = True
+                try:
+                    self._replay(self.journal_path, start)
+                finally:
+                    self._replaying = False
+                # the journal may have been truncated by _replay()
+                self._file_state = self._file_signature()
+            else:
+                self.open()
+        return True
+
+    def _file_signature(self):
+        """Returns the counter of writes stored in the lock file, and the
+        inode, size and modification time of the base file and of the
+        journal, used to detect the changes made by other processes. The
+        file lock must be held"""
+        result = [self._file_lock.counter()]
+        for path in (self.path, self.journal_path):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                result.append(None)
+            else:
+                result.append((stat.st_ino, stat.st_size, stat.st_mtime))
+        return tuple(result)
+
+    def _check_file_state(self):
+        """Raise IOError if another process has written the base file or its
+        journal since this instance read or wrote it. The exclusive file
+        lock must be held"""
+        if (self._file_state is not None and
+                self._file_signature() != self._file_state):
+            raise IOError("Base {} was changed by another process, call "
+                          "refresh() to reload it".format(self.path))
+
+    def _written(self):
+        """Called after the base file or the journal is written, with the
+        exclusive file lock"""
+        self._file_lock.increment()
+        self._file_state = self._file_signature()
+
+    def _make_layout(self):
+        """Returns the positions of the values in compact records"""
+        fields = ["__id__", "__version__"] + self.fields
+        return dict((f, pos) for (pos, f) in enumerate(fields))
+
+    def _make_record(self, values):
+        """Returns a compact record from the values of __id__, __version__
+        and the fields"""
+        return Record(self._layout, values)
+
+    def _convert_records(self):
+        """Convert the records loaded from the base file, if they are
+        compact records and the base uses dictionaries, or the opposite"""
+        records = self.records
+        if not self.compact_records:
+            for (_id, r) in records.items():
+                if type(r) is Record:
+                    records[_id] = dict(r.items())
+            return
+        for (_id, r) in records.items():
+            if type(r) is not Record:
+                values = [r["__id__"], r["__version__"]]
+                values.extend([r[f] for f in self.fields])
+                records[_id] = Record(self._layout, values)
+            elif r._layout is not self._layout:
+                if r._layout == self._layout:
+                    # share the layout loaded with the records
+                    self._layout = r._layout
+                else:
+                    records[_id] = Record(self._layout,
+                                          [r[f] for f in self._layout])
+
+    def _replay_journal(self):
+        """Apply the changes stored in the journal files, if any, on top of
+        the content loaded from the base file"""
+        if self._changes is not None:
+            # uncommitted changes are discarded by open()
+            self._changes = []
+        self._replaying = True
+        try:
+            # the previous journal is left by a background compact() that
+            # did not complete ; its changes are followed by the ones in the
+            # current journal
+            recover = self._replay(self.journal_path + "-old")
+            if recover:
+                self._generation += 1
+            self._replay(self.journal_path)
+        finally:
+            self._replaying = False
+        self._uncommitted = 0
+        self._last_commit = time.time()
+        if recover and self.save_to_file:
+            self.compact()
+
+    def _replay(self, path, start=None):
+        """Apply the changes stored in the journal file at path, if it was
+        started on the current generation of the base file. Returns True if
+        the changes were applied. If start is set, only the changes after
+        this position are applied"""
+        if path == self.journal_path:
+            self._journal_end = 0
+        if not os.path.isfile(path):
+            return False
+        with open(path, "rb") as _in:
+            stat = os.fstat(_in.fileno())
+            if start is not None:
+                _in.seek(start)
+                header = ("generation", self._generation)
+            else:
+                try:
+                    header = pickle.load(_in)
+                except (EOFError, pickle.UnpicklingError):
+                    header = None
+            if header != ("generation", self._generation):
+                # journal started on another generation of the base file,
+                # its changes are already in the base file
+                end = None
+            else:
+                end = _in.tell()
+                while True:
+                    try:
+                        change = pickle.load(_in)
+                    except (EOFError, pickle.UnpicklingError):
+                        # end of the journal, or last change truncated by
+                        # a crash while it was written
+                        break
+                    self._apply_change(*change)
+                    end = _in.tell()
+                if path == self.journal_path:
+                    self._journal_end = end
+        if self.save_to_file and (end is None or end < stat.st_size):
+            self._clean_journal(path, end, stat)
+        return end is not None
+
+    def _clean_journal(self, path, end, stat):
+        """Remove the journal at path if end is None, else drop the
+        truncated change after position end, so that new changes can be
+        appended after the last valid one. stat is the result of os.stat()
+        for the journal when it was read : if another process has changed or
+        removed the journal since then, it is left as it is"""
+        try:
+            with self._file_lock.locked(exclusive=True):
+                current = os.stat(path)
+                if (current.st_ino, current.st_size) != (stat.st_ino,
+                                                         stat.st_size):
+                    return
+                if end is None:
+                    os.remove(path)
+                else:
+                    with open(path, "r+b") as out:
+                        out.truncate(end)
+                self._written()
+        except (IOError, OSError):
+            # removed by another process, or the directory is read-only :
+            # the journal is cleaned by the next process writing the base
+            pass
+
+    def _apply_change(self, operation, *args):
+        """Apply a change read from the journal"""
+        if operation == "insert":
+            self.insert(**args[0])
+        elif operation == "insert_many":
+            self.insert_many(args[0])
+        elif operation == "update":
+            self.update([self.records[_id] for _id in args[0]], **args[1])
+        elif operation == "delete":
+            self.delete([self.records[_id] for _id in args[0]])
+        elif operation == "add_field":
+            self._add_field(*args)
+        elif operation == "drop_field":
+            self._drop_field(*args)
+        else:
+            raise ValueError("Invalid change in journal : {}".format(operation))
+
+    def _log(self, *change):
+        """Called after each change. Keeps the change until it is appended
+        to the journal by commit(), and starts a background commit if one
+        of the autocommit thresholds is reached"""
+        if self._replaying:
+            return
+        if self._changes is not None:
+            self._changes.append(pickle.dumps(change, self.protocol))
+        self._uncommitted += 1
+        if ((self.commit_every and self._uncommitted >= self.commit_every)
+                or (self.commit_interval and
+                    time.time() - self._last_commit >= self.commit_interval)):
+            self.commit(background=True)
+
+    @writer
+    def commit(self, background=False):
+        """Write the database to a file
+
+        If the base uses a journal, only the changes made since the previous
+        commit are appended to the journal file
+
+        Args:
+            - background (bool): if True and the whole base is written, the
+              file is written by a thread, from shallow copies of the
+              records and the indices. Until the file is written, the
+              records and the lists of ids of the indices are copied
+              before they are changed. Use wait_commit() to wait until the
+              file is written.
+        """
+        if self.save_to_file is False:
+            return
+        if not self.journal:
+            return self.compact(background)
+        self._uncommitted = 0
+        self._last_commit = time.time()
+        if not self._changes:
+            return
+        changes = self._changes
+        with self._file_lock.locked(exclusive=True):
+            self._check_file_state()
+            if not os.path.isfile(self.journal_path):
+                header = ("generation", self._generation)
+                changes = [pickle.dumps(header, self.protocol)] + changes
+            with open(self.journal_path, "ab") as out:
+                out.write(b"".join(changes))
+                out.flush()
+                os.fsync(out.fileno())
+                self._journal_end = out.tell()
+            self._written()
+        self._changes = []
+
+    @writer
+    def compact(self, background=False):
+        """Write the whole database to a file and remove the journal
+
+        The base is written to a temporary file which then replaces the
+        base file, so that a crash while writing leaves the previous
+        version of the base file unchanged.
+
+        Args:
+            - background (bool): if True, the file is written by a thread,
+              from a copy-on-write snapshot of the records and the indices
+              (see :meth:`commit`).
+        """
         if self.save_to_file is False:
             return
-        with open(self.path, "wb") as out:
-            pickle.dump(self.fields, out, self.protocol)
-            pickle.dump(self.next_id, out, self.protocol)
-            pickle.dump(self.records, out, self.protocol)
-            pickle.dump(self.indices, out, self.protocol)
-            pickle.dump(self.default_values, out, self.protocol)
+        self.wait_commit()
+        # records stored in columns are read from the files while they are
+        # written : they can't be written in the background
+        background = (background and self.storage != "columnar" and
+                      not isinstance(self.records, storage.LazyRecords))
+        journals = [self.journal_path + "-old"]
+        with self._file_lock.locked(exclusive=True):
+            self._check_file_state()
+            if background:
+                if self.journal:
+                    self.commit()
+                if os.path.isfile(self.journal_path):
+                    # changes committed while the file is written go to a
+                    # new journal
+                    _replace(self.journal_path, self.journal_path + "-old")
+                    self._journal_end = 0
+                    self._written()
+            else:
+                journals.append(self.journal_path)
+            if self._changes is not None:
+                self._changes = []
+            self._uncommitted = 0
+            self._last_commit = time.time()
+            self._generation += 1
+            if not background:
+                header = self._write(self.fields, self.next_id, self.records,
+                                     self.indices, self.default_values,
+                                     self._generation, journals)
+                if isinstance(header, storage.ColumnsHeader):
+                    self._open_columns(header)
+                elif isinstance(self.records, storage.LazyRecords):
+                    # the base was converted from columns : all the records
+                    # are now in memory
+                    self.records.store.close()
+                    self.records = header
+                    self._remove_columns()
+                return
+        # Take a snapshot of the base : shallow copies of the records and of
+        # the indices, that share the records and the lists of ids with the
+        # base. Until the thread has serialized them, the records and the
+        # lists of ids are copied before they are changed (copy-on-write)
+        records = dict(self.records)
+        indices = dict((f, ix.snapshot()) for (f, ix) in self.indices.items())
+        self._snapshot = records
+        args = (list(self.fields), self.next_id, records, indices,
+                dict(self.default_values), self._generation, journals)
+        self._commit_thread = threading.Thread(target=self._write_background,
+                                               args=args)
+        self._commit_thread.start()
+
+    def _write(self, fields, next_id, records, indices, default_values,
+               generation, journals):
+        """Write the base file and remove the journals it replaces. Returns
+        the object stored in the base file for the records. Raises IOError
+        if another process has written the base since this instance read or
+        wrote it, for a background commit that was started before"""
+        with self._file_lock.locked(exclusive=True):
+            self._check_file_state()
+            records = self._write_files(fields, next_id, records, indices,
+                                        default_values, generation, journals)
+            if self.journal_path in journals:
+                self._journal_end = 0
+            self._written()
+        return records
+
+    def _write_files(self, fields, next_id, records, indices, default_values,
+                     generation, journals):
+        tmp_path = self.path + ".tmp"
+        if self.storage == "columnar":
+            directory = "{}.columns-{}".format(self.path, generation)
+            records = storage.write_columns(directory, fields, records,
+                                            self.protocol)
+        elif type(records) is not dict:
+            records = dict(records.items())
+        try:
+            with open(tmp_path, "wb") as out:
+                pickle.dump(fields, out, self.protocol)
+                pickle.dump(next_id, out, self.protocol)
+                pickle.dump(records, out, self.protocol)
+                pickle.dump(indices, out, self.protocol)
+                pickle.dump(default_values, out, self.protocol)
+                pickle.dump(generation, out, self.protocol)
+                out.flush()
+                os.fsync(out.fileno())
+            _replace(tmp_path, self.path)
+            for path in journals:
+                if os.path.isfile(path):
+                    os.remove(path)
+        except Exception:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return records
 
+    def _open_columns(self, header):
+        """Read the records from the column files described by header.
+        Records already in memory are kept, and column files of previous
+        generations are removed"""
+        base_dir = os.path.dirname(os.path.abspath(self.path))
+        factory = self._make_record if self.compact_records else None
+        records = storage.LazyRecords(storage.ColumnStore(base_dir, header),
+                                      self.fields, self.default_values,
+                                      self.cache_size, factory)
+        if isinstance(self.records, storage.LazyRecords):
+            records.cache(self.records.loaded())
+            self.records.store.close()
+        elif self.records is not None:
+            records.cache(self.records.values())
+        self.records = records
+        if self.save_to_file:
+            self._remove_columns(keep=header.directory)
+
+    def _remove_columns(self, keep=None):
+        """Remove the directories of column files, except keep"""
+        base_dir = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path) + ".columns-"
+        for name in os.listdir(base_dir):
+            if name.startswith(prefix) and name != keep:
+                shutil.rmtree(os.path.join(base_dir, name),
+                              ignore_errors=True)
+
+    def _write_background(self, *args):
+        try:
+            self._write(*args)
+        except Exception as exc:
+            self._commit_error = exc
+        finally:
+            self._snapshot = None
+            for index in list(self.indices.values()):
+                index.release_snapshot()
+
+    def wait_commit(self):
+        """Wait until the background commit in progress, if any, is done.
+        Raises the exception that made it fail, if any"""
+        thread, self._commit_thread = self._commit_thread, None
+        if thread is not None:
+            thread.join()
+        error, self._commit_error = self._commit_error, None
+        if error is not None:
+            raise error
+
+    @writer
     def insert(self, *args, **kw):
         """
         Insert one or more records in the database.
@@ -278,37 +1644,116 @@ class _Base(object):
             raise RuntimeError("Database columns have not been setup!")
         if args:
             if self.sqlite_compat and isinstance(args[0], (list, tuple)):
-                for e in args[0]:
-                    if type(e) is dict:
-                        self.insert(**e)
-                    else:
-                        self.insert(*e)
+                self.insert_many(args[0])
                 return None
             kw = dict([(f, arg) for f, arg in zip(self.fields, args)])
-        # initialize all fields to the default values
-        import copy
-        record = copy.deepcopy(self.default_values)
         # raise exception if unknown field
         for key in kw:
             if key not in self.fields:
                 raise NameError("Invalid field name : {}".format(key))
-        # set keys and values
-        for (k, v) in kw.items():
-            record[k] = v
-        # add the key __id__ : record identifier
-        record["__id__"] = self.next_id
-        # add the key __version__ : version number
-        record["__version__"] = 0
+        if self.compact_records:
+            record = self._new_record(kw)
+        else:
+            # initialize all fields to the default values
+            record = _copy_defaults(self.default_values)
+            # set keys and values
+            for (k, v) in kw.items():
+                record[k] = v
+            # add the key __id__ : record identifier
+            record["__id__"] = self.next_id
+            # add the key __version__ : version number
+            record["__version__"] = 0
+        self._check_unique([(record, None)])
         # create an entry in the dictionary self.records, indexed by __id__
         self.records[self.next_id] = record
         # update index
-        for ix in self.indices.keys():
-            bisect.insort(self.indices[ix].setdefault(record[ix], []),
-                self.next_id)
+        for (f, index) in self.indices.items():
+            index.add(_index_value(record, f), self.next_id)
+        if self._vectors is not None:
+            self._vectors.insert([record])
         # increment the next __id__
         self.next_id += 1
+        self._log("insert", kw)
         return record["__id__"]
 
+    @writer
+    def insert_many(self, rows):
+        """Insert a list of records
+
+        The fields are validated once for all the records, and the ids of
+        the new records, greater than the ids in the indices, are appended
+        to the lists of ids of the indices
+
+        Args:
+            - rows (iterable): the records to insert, as dictionaries or as
+              lists of values in the order of the fields
+
+        Returns:
+            - the identifier of the last record inserted, or None if rows
+              is empty
+        """
+        if not self.mode:
+            raise RuntimeError("Database columns have not been setup!")
+        rows = [row if isinstance(row, dict) else dict(zip(self.fields, row))
+                for row in rows]
+        if not rows:
+            return None
+        keys = set()
+        for row in rows:
+            keys.update(row)
+        for key in keys:
+            if key not in self.fields:
+                raise NameError("Invalid field name : {}".format(key))
+        records = []
+        if self.compact_records:
+            layout = self._layout
+            defaults = [None, 0]
+            defaults.extend([self.default_values.get(f) for f in self.fields])
+            shared = all(_immutable(v) for v in defaults)
+            for (_id, row) in enumerate(rows, self.next_id):
+                values = list(defaults) if shared else copy.deepcopy(defaults)
+                values[0] = _id
+                for (k, v) in row.items():
+                    values[layout[k]] = v
+                records.append(Record(layout, values))
+        else:
+            defaults = self.default_values
+            shared = all(_immutable(v) for v in defaults.values())
+            for (_id, row) in enumerate(rows, self.next_id):
+                record = dict(defaults) if shared else copy.deepcopy(defaults)
+                record.update(row)
+                record["__id__"] = _id
+                record["__version__"] = 0
+                records.append(record)
+        self._check_unique([(record, None) for record in records])
+        for record in records:
+            self.records[record["__id__"]] = record
+        # update each index once per value
+        for (f, index) in self.indices.items():
+            buckets = {}
+            for record in records:
+                buckets.setdefault(_index_value(record, f), []).append(
+                    record["__id__"])
+            for (value, ids) in buckets.items():
+                index.extend(value, ids)
+        if self._vectors is not None:
+            self._vectors.insert(records)
+        self.next_id += len(records)
+        self._log("insert_many", rows)
+        return self.next_id - 1
+
+    def _new_record(self, kw):
+        """Returns a new Record with the default values and the values in
+        kw"""
+        layout = self._layout
+        values = [self.next_id, 0]
+        values.extend([self.default_values.get(f) for f in self.fields])
+        values = _copy_defaults(values)
+        for (k, v) in kw.items():
+            values[layout[k]] = v
+        return Record(layout, values)
+
+    @writer
     def delete(self, remove):
         """
         Remove a single record, or the records in an iterable
@@ -322,7 +1767,7 @@ class _Base(object):
         Returns:
             - Return the number of deleted items
         """
-        if isinstance(remove, dict):
+        if isinstance(remove, (dict, Record)):
             remove = [remove]
         else:
             # convert iterable into a list (to be able to sort it)
@@ -331,10 +1776,9 @@ class _Base(object):
             return 0
         _ids = [r["__id__"] for r in remove]
         _ids.sort()
-        keys = set(self.records.keys())
         # check if the records are in the base
-        if not set(_ids).issubset(keys):
-            missing = list(set(_ids).difference(keys))
+        missing = [_id for _id in _ids if _id not in self.records]
+        if missing:
             raise IndexError("Delete aborted. Records with these ids not "
                              "found in the base : {}".format(str(missing)))
         # raise exception if duplicate ids
@@ -342,20 +1786,59 @@ class _Base(object):
             if _ids[i] == _ids[i + 1]:
                 msg = "Delete aborted. Duplicate id : {}"
                 raise IndexError(msg.format(_ids[i]))
-        deleted = len(remove)
-        while remove:
-            r = remove.pop()
-            _id = r['__id__']
-            # remove id from indices
-            for indx in self.indices.keys():
-                pos = bisect.bisect(self.indices[indx][r[indx]], _id) - 1
-                del self.indices[indx][r[indx]][pos]
-                if not self.indices[indx][r[indx]]:
-                    del self.indices[indx][r[indx]]
-            # remove record from self.records
-            del self.records[_id]
-        return deleted
+        self._delete(_ids)
+        return len(_ids)
+
+    def _delete(self, ids):
+        """Remove the records with the ids in the sorted list ids from the
+        records and the indices. The ids are grouped by value for each index,
+        so that each list of ids is rebuilt once"""
+        records = self.records
+        for (f, index) in self.indices.items():
+            buckets = {}
+            for _id in ids:
+                buckets.setdefault(_index_value(records[_id], f), []).append(
+                    _id)
+            for (value, value_ids) in buckets.items():
+                index.remove_many(value, value_ids)
+        if self._vectors is not None:
+            self._vectors.delete(ids)
+        for _id in ids:
+            del records[_id]
+        self._log("delete", ids)
+
+    @writer
+    def delete_where(self, db_filter):
+        """Delete the records selected by a filter. The ids of the records
+        are found with the indices or with a scan, without building the
+        list of the records
 
+        Args:
+            - db_filter (PyDbFilter or PyDbExpressionGroup): the filter
+
+        Returns:
+            - the number of records deleted
+        """
+        group = db_filter
+        if isinstance(db_filter, PyDbFilter):
+            group = db_filter.expression_group
+            if (db_filter._offset or db_filter._limit is not None or
+                    db_filter._order is not None):
+                group = None
+        if group is None:
+            ids = sorted([r["__id__"] for r in db_filter])
+        elif group.is_dummy():
+            ids = list(self.records.keys())
+        else:
+            ids = group.index_ids(self)
+            if ids is None:
+                test = group.compile()
+                ids = [_id for (_id, r) in self.records.items() if test(r)]
+        if ids:
+            self._delete(ids)
+        return len(ids)
+
+    @writer
     def update(self, records, **kw):
         """
         Update one record or a list of records
@@ -366,52 +1849,211 @@ class _Base(object):
         """
         # ignore unknown fields
         kw = dict([(k, v) for (k, v) in kw.items() if k in self.fields])
-        if isinstance(records, dict):
+        if isinstance(records, (dict, Record)):
             records = [records]
+        else:
+            # records may be a filter or an iterator, read only once
+            records = list(records)
+        self._update([(record, kw) for record in records])
+        self._log("update", [r["__id__"] for r in records], kw)
+
+    def _update(self, changes):
+        """Update records and indices. changes is a list of (record,
+        values), where values is a dictionary with the new values of some
+        fields of the record. The ids moved from or to a value of an index
+        are removed or added at once"""
+        # the record passed by the caller may be an older version (thread
+        # safe base) or a copy evicted from the cache (column storage) :
+        # change the record stored in the base
+        changes = [(self.records[record["__id__"]], values)
+                   for (record, values) in changes]
+        self._check_unique(changes)
         # update indices
-        for indx in set(self.indices.keys()) & set(kw.keys()):
-            for record in records:
-                if record[indx] == kw[indx]:
+        for (indx, index) in self.indices.items():
+            fields = set(_index_fields(indx))
+            # ids moved from each old value and to each new value
+            removed, added = {}, {}
+            for (record, values) in changes:
+                if fields.isdisjoint(values):
                     continue
-                _id = record["__id__"]
-                # remove id for the old value
-                old_pos = bisect.bisect(self.indices[indx][record[indx]],
-                    _id) - 1
-                del self.indices[indx][record[indx]][old_pos]
-                if not self.indices[indx][record[indx]]:
-                    del self.indices[indx][record[indx]]
-                # insert new value
-                bisect.insort(self.indices[indx].setdefault(kw[indx], []),
-                    _id)
-        for record in records:
+                old = _index_value(record, indx)
+                new = _index_value(record, indx, values)
+                if old != new:
+                    removed.setdefault(old, []).append(record["__id__"])
+                    added.setdefault(new, []).append(record["__id__"])
+            for (old, ids) in removed.items():
+                index.remove_many(old, sorted(ids))
+            for (new, ids) in added.items():
+                index.add_many(new, sorted(ids))
+        lazy = isinstance(self.records, storage.LazyRecords)
+        snapshot = self._snapshot
+        for (record, values) in changes:
+            if self._lock is not None or (
+                    snapshot is not None and
+                    snapshot.get(record["__id__"]) is record):
+                # new version of the record : the records returned before
+                # the update, or written by a background commit, are not
+                # changed
+                record = record.copy()
+                self.records[record["__id__"]] = record
             # update record values
-            record.update(kw)
+            record.update(values)
             # increment version number
             record["__version__"] += 1
+            if lazy:
+                # keep the record in memory until the next commit
+                self.records.touch(record)
+        if self._vectors is not None:
+            self._vectors.update(changes)
+
+    @writer
+    def update_where(self, db_filter, **kw):
+        """Update the records selected by a filter with the values in kw
+
+        Args:
+            - db_filter (PyDbFilter or PyDbExpressionGroup): the filter
+
+        Returns:
+            - the number of records updated
+        """
+        if isinstance(db_filter, PyDbExpressionGroup):
+            records = list(db_filter.iter_filter(self.records, self))
+        else:
+            records = list(db_filter)
+        if records:
+            self.update(records, **kw)
+        return len(records)
+
+    @writer
+    def upsert(self, key_fields, rows):
+        """Insert or update records. For each row, the records with the same
+        values of key_fields are updated with the values in the row ; if
+        there is no such record, a record is inserted
+
+        The records are found with the index on key_fields if there is one,
+        else with a single pass on the records. The indices are updated once
+        for all the updated records
 
+        Args:
+            - key_fields (str or list): the field, or the list of fields,
+              identifying a record
+            - rows (iterable): dictionaries mapping fields to values, with
+              a value for each of key_fields
+
+        Returns:
+            - a tuple (number of records inserted, number of records updated)
+        """
+        if isinstance(key_fields, (list, tuple)) and len(key_fields) > 1:
+            key = tuple(key_fields)
+        elif isinstance(key_fields, (list, tuple)):
+            key = key_fields[0]
+        else:
+            key = key_fields
+        for field in _index_fields(key):
+            if field not in self.fields:
+                raise NameError("Invalid field name : {}".format(field))
+        index = self.indices.get(key)
+        if index is not None:
+            lookup = index.ids
+        else:
+            existing = {}
+            for (_id, record) in self.records.items():
+                existing.setdefault(_index_value(record, key), []).append(_id)
+            lookup = lambda value: existing.get(value, [])  # noqa
+
+        updates = {}  # new values of the records to update, by __id__
+        inserts = {}  # values of the records to insert, by key value
+        order = []  # key values of the records to insert, in order
+        for row in rows:
+            for field in row:
+                if field not in self.fields:
+                    raise NameError("Invalid field name : {}".format(field))
+            value = _index_value(row, key)
+            ids = lookup(value)
+            if ids:
+                for _id in ids:
+                    updates.setdefault(_id, {}).update(row)
+            elif value in inserts:
+                inserts[value].update(row)
+            else:
+                inserts[value] = dict(row)
+                order.append(value)
+
+        if updates:
+            ids = sorted(updates)
+            self._update([(self.records[_id], updates[_id]) for _id in ids])
+            for _id in ids:
+                self._log("update", [_id], updates[_id])
+        for value in order:
+            self.insert(**inserts[value])
+        return len(order), len(updates)
+
+    @writer
     def add_field(self, field, column_type="ignored", default=None):
         """Adds a field to the database"""
         if field in self.fields + ["__id__", "__version__"]:
             raise ValueError("Field {} already defined".format(field))
         if not hasattr(self, "records"):  # base not open yet
             self.open()
-        for r in self:
-            r[field] = default
+        self._add_field(field, default)
+        self.commit()
+
+    def _add_field(self, field, default):
+        # the records of a background commit share the layout
+        self.wait_commit()
+        if isinstance(self.records, storage.LazyRecords):
+            self.records.add_field(field)
+        if self.compact_records:
+            for r in self._records_in_memory():
+                list.append(r, default)
+            self._layout[field] = len(self._layout)
+        else:
+            for r in self._records_in_memory():
+                r[field] = default
         self.fields.append(field)
         self.default_values[field] = default
-        self.commit()
+        self._log("add_field", field, default)
+
+    def _records_in_memory(self):
+        """Returns the records loaded in memory : all the records, except
+        for a base stored in columns"""
+        if isinstance(self.records, storage.LazyRecords):
+            return self.records.loaded()
+        return self.records.values()
 
+    @writer
     def drop_field(self, field):
         """Removes a field from the database"""
         if field in ["__id__", "__version__"]:
             raise ValueError("Can't delete field {}".format(field))
-        self.fields.remove(field)
-        for r in self:
-            del r[field]
-        if field in self.indices:
-            del self.indices[field]
+        self._drop_field(field)
         self.commit()
 
+    def _drop_field(self, field):
+        # the records of a background commit share the layout
+        self.wait_commit()
+        self.fields.remove(field)
+        if isinstance(self.records, storage.LazyRecords):
+            self.records.drop_field(field)
+        if self.compact_records:
+            layout = self._layout
+            pos = layout.pop(field)
+            for r in self._records_in_memory():
+                list.__delitem__(r, pos)
+            for (k, p) in layout.items():
+                if p > pos:
+                    layout[k] = p - 1
+        else:
+            for r in self._records_in_memory():
+                del r[field]
+        for key in list(self.indices):
+            if field in _index_fields(key):
+                del self.indices[key]
+        if self._vectors is not None:
+            self._vectors.drop_field(field)
+        self._log("drop_field", field)
+
+    @reader
     def __call__(self, *args, **kw):
         """Selection by field values
 
@@ -433,43 +2075,73 @@ class _Base(object):
         if args:
             if len(args) > 1:
                 raise SyntaxError("Only one field can be specified")
-            elif (type(args[0]) is PyDbExpressionGroup
-                    or type(args[0]) is PyDbFilter):
+            elif type(args[0]) is PyDbExpressionGroup:
+                return args[0].apply_filter(self.records, self)
+            elif type(args[0]) is PyDbFilter:
                 return args[0].apply_filter(self.records)
             elif args[0] not in self.fields:
                 raise ValueError("{} is not a field".format(args[0]))
             else:
                 return PyDbFilter(self, args[0])
         if not kw:
+            if self._lock is not None:
+                return list(self.records.values())
             return self.records.values()  # db() returns all the values
 
         # indices and non-indices
-        keys = kw.keys()
-        ixs = set(keys) & set(self.indices.keys())
-        no_ix = set(keys) - ixs
-        if ixs:
-            # fast selection on indices
-            ix = ixs.pop()
-            res = set(self.indices[ix].get(kw[ix], []))
+        keys = set(kw.keys())
+        res = None
+        # index on several fields whose first fields are in kw
+        key, n = self._composite_index(keys)
+        if n > 1 or (n == 1 and key[0] not in self.indices):
+            index = self.indices[key]
+            value = tuple([kw[f] for f in key[:n]])
+            res = set(index.ids(value) if n == len(key)
+                      else index.prefix_ids(value))
             if not res:
                 return []
-            while ixs:
-                ix = ixs.pop()
-                res = res & set(self.indices[ix].get(kw[ix], []))
-        else:
+            keys -= set(key[:n])
+        ixs = keys & set(self.indices.keys())
+        no_ix = keys - ixs
+        # combine the bitmap indices first
+        bitmaps = [ix for ix in ixs
+                   if isinstance(self.indices[ix], BitmapIndex)]
+        if bitmaps:
+            bits = self.indices[bitmaps[0]].bits(kw[bitmaps[0]])
+            for ix in bitmaps[1:]:
+                bits &= self.indices[ix].bits(kw[ix])
+            ids = set(int_to_ids(bits))
+            res = ids if res is None else res & ids
+            ixs -= set(bitmaps)
+        if res is None and ixs:
+            ix = ixs.pop()
+            res = set(self.indices[ix].ids(kw[ix]))
+        # fast selection on indices
+        while ixs and res:
+            ix = ixs.pop()
+            res = res & set(self.indices[ix].ids(kw[ix]))
+        if res is None:
             # if no index, initialize result with test on first field
             field = no_ix.pop()
-            res = set([r["__id__"] for r in self if r[field] == kw[field]])
+            value = kw[field]
+            if self._parallel(self.records):
+                res = set(parallel.select(
+                    self.records, lambda r: r[field] == value,
+                    self.processes))
+            else:
+                res = set([r["__id__"] for r in self if r[field] == value])
         # selection on non-index fields
         for field in no_ix:
             res = res & set([_id for _id in res
                 if self.records[_id][field] == kw[field]])
         return [self.records[_id] for _id in res]
 
+    @reader
     def __getitem__(self, key):
         # direct access by record id
         return self.records[key]
 
+    @reader
     def _len(self, db_filter=None):
         if db_filter is not None:
             if (type(db_filter) is not PyDbExpressionGroup
@@ -478,7 +2150,9 @@ class _Base(object):
                     "'PyDbExpressionGroup' or 'PyDbFilter': {}")
                 raise ValueError(msg.format(type(db_filter)))
             if db_filter.is_filtered():
-                return len(db_filter.apply_filter(self.records))
+                if type(db_filter) is PyDbExpressionGroup:
+                    return db_filter.count(self.records, self)
+                return len(db_filter)
         return len(self.records)
 
     def __len__(self):
@@ -488,40 +2162,235 @@ class _Base(object):
         """Delete by record id"""
         self.delete(self[record_id])
 
+    @reader
     def __contains__(self, record_id):
         return record_id in self.records
 
     def group_by(self, column, torrents_filter):
         """Returns the records grouped by column"""
-        gropus = [(k, len(list(g)))
-                    for k, g in groupby(torrents_filter,
-                                        key=lambda x: x[column])]
         result = {}
-        for column, count in gropus:
-            result[column] = result.get(column, 0) + count
-        return [(c, result[c]) for c in result]
+        for record in torrents_filter:
+            value = record[column]
+            result[value] = result.get(value, 0) + 1
+        return list(result.items())
 
-    def filter(self, key=None):
-        return PyDbFilter(self, key)
+    @reader
+    def aggregate(self, group_by=None, db_filter=None, **kw):
+        """Computes aggregates on the records, grouped by the values of some
+        fields, in a single pass on the records
 
-    def get_group_count(self, group_by_field, db_filter=None):
+        Args:
+            - group_by (str or list): the field or the list of fields whose
+              values define the groups. If None, all the records are in a
+              single group
+            - db_filter (PyDbFilter or PyDbExpressionGroup): if set, only the
+              records selected by the filter are aggregated
+            - count (bool): if True (the default), count the records of
+              each group
+            - sum, min, max, avg (str or list): the field or the list of
+              fields to compute the sum, minimum, maximum or average of.
+              None values are ignored
+
+        Returns:
+            - a list of dictionaries, one for each group, sorted by the values
+              of the group_by fields. Each dictionary has the values of the
+              group_by fields, the number of records in "count", and the
+              aggregates in keys like "sum(field)"
+
+        If the only aggregate is the count of records grouped by an indexed
+        field, or by the fields of an index on several fields, the counts are
+        read in the index.
+        """
+        if group_by is None:
+            group_by = []
+        elif not isinstance(group_by, (list, tuple)):
+            group_by = [group_by]
+        count = kw.pop("count", True)
+        aggregates = []
+        for func in ("sum", "min", "max", "avg"):
+            fields = kw.pop(func, [])
+            if not isinstance(fields, (list, tuple)):
+                fields = [fields]
+            aggregates += [(func, field) for field in fields]
+        if kw:
+            raise TypeError("Unexpected arguments {}".format(list(kw)))
+        db_filter = self._as_filter(db_filter)
+        for field in list(group_by) + [field for (_, field) in aggregates]:
+            if field != "__id__" and field not in self.fields:
+                raise ValueError("{} is not a field".format(field))
+
+        counts = None
+        if len(group_by) == 1 and not aggregates:
+            counts = self._group_counts(group_by[0], db_filter)
+            if counts is not None:
+                counts = dict(((value,), n) for value, n in counts.items())
+        elif group_by and not aggregates:
+            # index on the group_by fields
+            counts = self._index_counts(tuple(group_by), db_filter)
+        if counts is not None:
+            groups = dict((key, [n]) for key, n in counts.items())
+        else:
+            groups = self._aggregate(group_by, aggregates, db_filter)
+        if not group_by and not groups:
+            groups[()] = [0] + [None] * len(aggregates)
+
+        result = []
+        for key in sorted(groups, key=lambda k: [sort_key(v) for v in k]):
+            values = groups[key]
+            group = dict(zip(group_by, key))
+            if count:
+                group["count"] = values[0]
+            for (func, field), value in zip(aggregates, values[1:]):
+                if func == "avg" and value is not None:
+                    value = value[0] / float(value[1])
+                group["{}({})".format(func, field)] = value
+            result.append(group)
+        return result
+
+    def _aggregate(self, group_by, aggregates, db_filter):
+        """Hash aggregation for :meth:`aggregate`. Returns a dictionary
+        mapping the tuples of values of the group_by fields to the list of
+        the number of records and the values of the aggregates. If the
+        records are scanned by worker processes, each process aggregates
+        the records of its chunks, and the groups are merged"""
+        test = self._parallel_test(db_filter)
+        if test is not None:
+            def chunk_groups(records):
+                return _groups((r for r in records if test(r)), group_by,
+                               aggregates)
+            return _merge_groups(
+                parallel.map_chunks(self.records, chunk_groups,
+                                    self.processes), aggregates)
+        if db_filter is None:
+            records = self.records.values()
+        else:
+            records = iter(db_filter)
+        return _groups(records, group_by, aggregates)
+
+    def _parallel(self, records):
+        """True if the records are scanned by worker processes"""
+        return bool(self.processes) and len(records) >= parallel.MIN_RECORDS
+
+    def _parallel_test(self, db_filter):
+        """If the records selected by db_filter are found by a scan of the
+        base with worker processes, returns the function testing the
+        records, else None"""
+        if not self._parallel(self.records):
+            return None
         if db_filter is None:
-            db_filter = self.filter()
+            return _accept
+        if db_filter._offset or db_filter._limit is not None:
+            return None
+        group = db_filter.expression_group
+        if group.is_dummy():
+            return _accept
+        if group._uses_indices(self) or group.mask(self) is not None:
+            return None
+        return group.compile()
+
+    def _index_counts(self, field, db_filter=None):
+        """If field is indexed, returns a dictionary mapping the values of
+        field in the records selected by db_filter to the number of these
+        records, read in the index. Returns None if the index can't be
+        used"""
+        index = self.indices.get(field)
+        if index is None:
+            return None
+        if db_filter is not None and (db_filter._offset or
+                                      db_filter._limit is not None):
+            return None
+        if db_filter is None or not db_filter.is_filtered():
+            return dict((value, index.count(value)) for value in index)
+        counts = {}
+        if isinstance(index, BitmapIndex):
+            bits = db_filter.expression_group.bitmap(self)
+            if bits is not None:
+                # intersect the bitmaps of the filter and of each value
+                for value in index:
+                    n = count_bits(bits & index.bits(value))
+                    if n:
+                        counts[value] = n
+                return counts
+        ids = db_filter.expression_group.index_ids(self)
+        if ids is None:
+            return None
+        # intersect the ids selected by the filter with each list of ids
+        ids = set(ids)
+        for value in index:
+            n = len(ids.intersection(index.ids(value)))
+            if n:
+                counts[value] = n
+        return counts
+
+    def _vector_counts(self, field, db_filter=None):
+        """If the base keeps NumPy arrays (vectorize=True), returns a
+        dictionary mapping the values of field in the records selected by
+        db_filter to the number of these records, computed with the arrays.
+        Returns None if the arrays can't be used"""
+        if self._vectors is None or field not in self.fields:
+            return None
+        if db_filter is not None and (db_filter._offset or
+                                      db_filter._limit is not None):
+            return None
+        mask = None
+        if db_filter is not None and db_filter.is_filtered():
+            mask = db_filter.expression_group.mask(self)
+            if mask is None:
+                return None
+        return self._vectors.counts(field, self.records, mask)
+
+    def _group_counts(self, field, db_filter=None):
+        """Returns a dictionary mapping the values of field in the records
+        selected by db_filter to the number of these records, read in the
+        index of field or computed with the NumPy arrays. Returns None if
+        neither can be used"""
+        counts = self._index_counts(field, db_filter)
+        if counts is None:
+            counts = self._vector_counts(field, db_filter)
+        return counts
+
+    def filter(self, key=None):
+        return PyDbFilter(self, key)
 
-        gropus = [(k, len(list(g)))
-                    for k, g in groupby(db_filter,
-                                        key=lambda x: x[group_by_field])]
-        groups_dict = {}
-        for group, count in gropus:
-            groups_dict[group] = groups_dict.get(group, 0) + count
-        return [(k, groups_dict[k]) for k in groups_dict]
+    def _as_filter(self, db_filter):
+        """Returns db_filter as a PyDbFilter : an expression group (the
+        attribute expression_group of a filter) is wrapped in a filter of the
+        base"""
+        if isinstance(db_filter, PyDbExpressionGroup):
+            group, db_filter = db_filter, self.filter()
+            db_filter.expression_group = group
+        return db_filter
 
+    @reader
+    def get_group_count(self, group_by_field, db_filter=None):
+        """Returns the list of (value, count) for the values of
+        group_by_field in the records selected by db_filter. If the field is
+        indexed, the counts are read in the index. db_filter is a
+        PyDbFilter or a PyDbExpressionGroup"""
+        db_filter = self._as_filter(db_filter)
+        counts = self._group_counts(group_by_field, db_filter)
+        if counts is None and self._parallel_test(db_filter) is not None:
+            groups = self._aggregate([group_by_field], [], db_filter)
+            return [(key[0], values[0]) for (key, values) in groups.items()]
+        if counts is None:
+            if db_filter is None:
+                db_filter = self.filter()
+            return self.group_by(group_by_field, db_filter)
+        return list(counts.items())
+
+    @reader
     def get_unique_ids(self, id_value, db_filter=None):
-        """Returns a set of unique values from column"""
+        """Returns a set of unique values from column. If the field is
+        indexed, the values are read in the index. db_filter is a PyDbFilter
+        or a PyDbExpressionGroup"""
+        db_filter = self._as_filter(db_filter)
+        counts = self._group_counts(id_value, db_filter)
+        if counts is not None:
+            return set(counts)
         if db_filter is not None and db_filter.is_filtered():
-            records = self(db_filter)
+            records = iter(db_filter)
         else:
-            records = self()
+            records = self.records.values()
         return set([row[id_value] for row in records])
 
     def get_indices(self):
@@ -531,15 +2400,21 @@ class _Base(object):
 
 class _BasePy2(_Base):
 
+    @reader
     def __iter__(self):
         """Iteration on the records"""
+        if self._lock is not None:
+            return iter(list(self.records.values()))
         return iter(self.records.itervalues())
 
 
 class _BasePy3(_Base):
 
+    @reader
     def __iter__(self):
         """Iteration on the records"""
+        if self._lock is not None:
+            return iter(list(self.records.values()))
         return iter(self.records.values())
 
 if sys.version_info[0] == 2:
@@ -55,6 +55,12 @@ except NameError:
     from sets import Set as set  # NOQA
 
 
+def regexp(pattern, value):
+    """Implementation of the REGEXP operator of SQLite, used by
+    :meth:`Filter.regex() <pydblite.common.Filter.regex>`"""
+    return isinstance(value, unicode) and re.search(pattern, value) is not None
+
+
 # classes for CURRENT_DATE, CURRENT_TIME, CURRENT_TIMESTAMP
 class CurrentDate:
     def __call__(self):
@@ -165,6 +171,7 @@ class Database(dict):
         dict.__init__(self)
         self.conn = sqlite.connect(filename, **kw)
         """The SQLite connection"""
+        self.conn.create_function("REGEXP", 2, regexp)
         self.cursor = self.conn.cursor()
         """The SQLite connections cursor"""
         for table_name in self._tables():
@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+#
+# BSD licence
+#
+# Column-oriented storage of the records of a pydblite base
+#
+# Each field is stored in its own file : integers, floats and booleans in
+# fixed-width arrays, strings and other values in a blob file with an array
+# of offsets. The files are opened with mmap and records are only built
+# when they are accessed.
+#
+
+import array
+import bisect
+import mmap
+import os
+import sys
+import threading
+
+from collections import OrderedDict
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # Python 2
+    from collections import MutableMapping
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+if sys.version_info[0] == 2:
+    text_type = unicode  # NOQA
+    int_types = (int, long)  # NOQA
+else:
+    text_type = str
+    int_types = (int,)
+
+# Kinds of columns
+INT = "q"  # 64 bits signed integers
+FLOAT = "d"  # double precision floats
+BOOL = "?"  # booleans, one byte per value
+TEXT = "s"  # strings encoded in utf-8, with offsets
+PICKLE = "p"  # any other value, pickled, with offsets
+
+# number of values buffered by the column writers
+_BUFFER_SIZE = 65536
+
+
+def check_supported():
+    """Raise ValueError if column storage is not available : the column
+    files are read with memoryview.cast(), which requires Python 3"""
+    if not hasattr(memoryview, "cast"):
+        raise ValueError("Column storage requires Python 3")
+
+
+def _kind(value):
+    """Returns the kind of column able to store value"""
+    _type = type(value)
+    if _type is bool:
+        return BOOL
+    if _type in int_types and -2 ** 63 <= value < 2 ** 63:
+        return INT
+    if _type is float:
+        return FLOAT
+    if _type is text_type:
+        return TEXT
+    return PICKLE
+
+
+class ColumnsHeader(object):
+    """Description of the column files of a base, stored in the base file
+    instead of the records"""
+
+    def __init__(self, directory, length, columns):
+        # name of the directory of the column files, in the directory of the
+        # base file
+        self.directory = directory
+        # number of records
+        self.length = length
+        # list of (field, kind, has_nulls), in the order of the files
+        self.columns = columns
+
+
+class _ColumnWriter(object):
+
+    def __init__(self, path, kind, has_nulls, protocol):
+        self.kind = kind
+        self.protocol = protocol
+        self.data = open(path + ".data", "wb")
+        if kind in (TEXT, PICKLE):
+            self.offsets = open(path + ".offsets", "wb")
+            self.offset = 0
+            self.buffer = array.array("q", [0])
+        else:
+            self.buffer = array.array("B" if kind == BOOL else kind)
+        self.nulls = open(path + ".nulls", "wb") if has_nulls else None
+        self.null_buffer = array.array("B")
+
+    def append(self, value):
+        if self.nulls is not None:
+            self.null_buffer.append(value is None)
+        if self.kind in (TEXT, PICKLE):
+            if value is not None or self.kind == PICKLE:
+                if self.kind == TEXT:
+                    value = value.encode("utf-8")
+                else:
+                    value = pickle.dumps(value, self.protocol)
+                self.data.write(value)
+                self.offset += len(value)
+            self.buffer.append(self.offset)
+        elif value is None:
+            self.buffer.append(0)
+        else:
+            self.buffer.append(value)
+        if len(self.buffer) >= _BUFFER_SIZE:
+            self.flush()
+
+    def copy(self, column, pos):
+        """Append the value at position pos of a :class:`_Column` of the
+        same kind, without decoding it"""
+        if self.nulls is not None:
+            self.null_buffer.append(column.nulls is not None and
+                                    column.nulls[pos])
+        if self.kind in (TEXT, PICKLE):
+            start, end = column.offsets[pos], column.offsets[pos + 1]
+            self.data.write(column.data[start:end])
+            self.offset += end - start
+            self.buffer.append(self.offset)
+        else:
+            self.buffer.append(column.data[pos])
+        if len(self.buffer) >= _BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        out = self.data if self.kind not in (TEXT, PICKLE) else self.offsets
+        self.buffer.tofile(out)
+        del self.buffer[:]
+        if self.nulls is not None:
+            self.null_buffer.tofile(self.nulls)
+            del self.null_buffer[:]
+
+    def close(self):
+        self.flush()
+        for out in (self.data, getattr(self, "offsets", None), self.nulls):
+            if out is not None:
+                out.close()
+
+
+def _merge_kinds(kind, other):
+    """Returns the kind of column able to store the values of columns of
+    kind and other (None for a column of None values)"""
+    if kind is None or kind == other:
+        return other
+    if other is None:
+        return kind
+    return PICKLE
+
+
+def _rows(records):
+    """Generator of (__id__, position, record) for the records, sorted by
+    __id__. For a record of :class:`LazyRecords` that was not changed since
+    the column files were written, record is None and position is its
+    position in the files, else position is None"""
+    if not isinstance(records, LazyRecords):
+        for _id in sorted(records):
+            yield _id, None, records[_id]
+        return
+    changed, deleted = records._changed, records._deleted
+    for (pos, _id) in enumerate(records.store.ids):
+        if _id in deleted:
+            continue
+        record = changed.get(_id)
+        yield _id, (pos if record is None else None), record
+    last_stored = records._last_stored
+    for _id in sorted(_id for _id in changed if _id > last_stored):
+        yield _id, None, changed[_id]
+
+
+def write_columns(directory, fields, records, protocol):
+    """Write the records to column files in directory
+
+    If records is a :class:`LazyRecords`, the records that were not changed
+    since its column files were written are copied from these files,
+    without building them
+
+    Args:
+        - directory (str): the directory of the column files, created
+          if it doesn't exist
+        - fields (list): the fields to write
+        - records (dict): mapping between __id__ and the records
+        - protocol (int): the pickle protocol
+
+    Returns:
+        - the :class:`ColumnsHeader` describing the files
+    """
+    check_supported()
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+    # first pass to find the kind of each column
+    kinds = dict((field, None) for field in fields)
+    nulls = set()
+    if isinstance(records, LazyRecords):
+        changed = records._changed
+        # the values of the records that were not changed
+        stored = records.store.length - len(records._deleted) - sum(
+            1 for _id in changed if _id <= records._last_stored)
+        for field in fields if stored else []:
+            column = records.store.columns.get(field)
+            if column is None:
+                # field added since the files were written
+                value = records.default_values.get(field)
+                kind = None if value is None else _kind(value)
+                has_nulls = value is None
+            else:
+                kind, has_nulls = column.kind, column.nulls is not None
+            kinds[field] = kind
+            if has_nulls:
+                nulls.add(field)
+        values = changed.values()
+    else:
+        values = records.values()
+    for record in values:
+        for field in fields:
+            value = record[field]
+            if value is None:
+                nulls.add(field)
+            else:
+                kinds[field] = _merge_kinds(kinds[field], _kind(value))
+    columns = []
+    writers = [_ColumnWriter(os.path.join(directory, "ids"), INT, False,
+                             protocol),
+               _ColumnWriter(os.path.join(directory, "versions"), INT, False,
+                             protocol)]
+    for i, field in enumerate(fields):
+        kind = kinds[field] or BOOL
+        columns.append((field, kind, field in nulls))
+        writers.append(_ColumnWriter(os.path.join(directory, str(i)), kind,
+                                     field in nulls, protocol))
+    length = 0
+    try:
+        for (_id, pos, record) in _rows(records):
+            length += 1
+            writers[0].append(_id)
+            if record is not None:
+                writers[1].append(record["__version__"])
+                for writer, field in zip(writers[2:], fields):
+                    writer.append(record[field])
+                continue
+            store = records.store
+            writers[1].append(store.versions[pos])
+            for writer, field in zip(writers[2:], fields):
+                column = store.columns.get(field)
+                if column is None:
+                    writer.append(records.default_values.get(field))
+                elif column.kind == writer.kind:
+                    writer.copy(column, pos)
+                else:
+                    writer.append(column[pos])
+    finally:
+        for writer in writers:
+            writer.close()
+    return ColumnsHeader(os.path.basename(directory), length, columns)
+
+
+class _Column(object):
+    """Values of a field, read from the mmapped column files"""
+
+    def __init__(self, store, path, kind, has_nulls):
+        self.kind = kind
+        if kind in (TEXT, PICKLE):
+            self.data = store._map(path + ".data")
+            self.offsets = store._map(path + ".offsets", "q")
+        else:
+            self.data = store._map(path + ".data",
+                                   "B" if kind == BOOL else kind)
+        self.nulls = store._map(path + ".nulls", "B") if has_nulls else None
+
+    def __getitem__(self, pos):
+        if self.nulls is not None and self.nulls[pos]:
+            return None
+        if self.kind == TEXT:
+            start, end = self.offsets[pos], self.offsets[pos + 1]
+            return self.data[start:end].tobytes().decode("utf-8")
+        elif self.kind == PICKLE:
+            start, end = self.offsets[pos], self.offsets[pos + 1]
+            return pickle.loads(self.data[start:end].tobytes())
+        elif self.kind == BOOL:
+            return bool(self.data[pos])
+        return self.data[pos]
+
+
+class ColumnStore(object):
+    """Read-only access to the column files described by a
+    :class:`ColumnsHeader`"""
+
+    def __init__(self, base_dir, header):
+        check_supported()
+        self.header = header
+        self.directory = os.path.join(base_dir, header.directory)
+        self.length = header.length
+        self._maps = []
+        self._views = []
+        self.ids = self._map(os.path.join(self.directory, "ids.data"), "q")
+        self.versions = self._map(os.path.join(self.directory,
+                                               "versions.data"), "q")
+        self.columns = {}
+        for i, (field, kind, has_nulls) in enumerate(header.columns):
+            path = os.path.join(self.directory, str(i))
+            self.columns[field] = _Column(self, path, kind, has_nulls)
+
+    def _map(self, path, fmt=None):
+        """Returns a memoryview on the content of the file at path"""
+        with open(path, "rb") as _in:
+            if os.fstat(_in.fileno()).st_size == 0:
+                # empty files can't be mapped
+                view = memoryview(b"")
+            else:
+                _map = mmap.mmap(_in.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps.append(_map)
+                view = memoryview(_map)
+        self._views.append(view)
+        if fmt is not None:
+            view = view.cast(fmt)
+            self._views.append(view)
+        return view
+
+    def position(self, _id):
+        """Returns the position of the record with the specified __id__,
+        raises KeyError if there is no such record"""
+        pos = bisect.bisect_left(self.ids, _id)
+        if pos == self.length or self.ids[pos] != _id:
+            raise KeyError(_id)
+        return pos
+
+    def record(self, pos, fields, default_values, factory=None):
+        """Returns the record at position pos, with the specified fields.
+        Fields that are not in the column files are set to their default
+        value. If factory is set, it is called with the list of the values
+        of __id__, __version__ and the fields to build the record, else the
+        record is a dictionary"""
+        values = [self.ids[pos], self.versions[pos]]
+        for field in fields:
+            column = self.columns.get(field)
+            if column is None:
+                values.append(default_values.get(field))
+            else:
+                values.append(column[pos])
+        if factory is not None:
+            return factory(values)
+        return dict(zip(["__id__", "__version__"] + fields, values))
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        for _map in self._maps:
+            _map.close()
+        self._views, self._maps = [], []
+
+
+class LazyRecords(MutableMapping):
+    """Mapping between __id__ and records for a base opened from column
+    files. A record is read from the files the first time it is accessed,
+    then kept in a cache. Records inserted or updated since the files were
+    written are kept in memory until the next commit. The cache is changed
+    by the methods that read the base, which can run at the same time in
+    several threads : it is changed by one thread at a time
+
+    Args:
+        - store (ColumnStore): the column files
+        - fields (list): the fields of the base
+        - default_values (dict): the default values of the fields
+        - cache_size (int): maximum number of unchanged records kept in
+          memory, the least recently used ones are removed first. If None,
+          all the records read are kept
+        - factory (callable): builds a record from the list of its values
+          (see :meth:`ColumnStore.record`)
+    """
+
+    def __init__(self, store, fields, default_values, cache_size=None,
+                 factory=None):
+        self.store = store
+        # the fields and default values of the base (shared with the base,
+        # so that added fields are seen by the mapping)
+        self.fields = fields
+        self.default_values = default_values
+        self.cache_size = cache_size
+        self.factory = factory
+        # records read from the files, in the order they were last
+        # accessed, and the mutex of the changes of the cache
+        self._cache = OrderedDict()
+        self._mutex = threading.Lock()
+        # records inserted or updated since the files were written
+        self._changed = {}
+        # ids of the records in the store that have been deleted
+        self._deleted = set()
+        # number of records inserted since the store was written
+        self._inserted = 0
+        self._last_stored = store.ids[-1] if store.length else -1
+
+    def _cache_record(self, _id, record):
+        self._cache[_id] = record
+        if self.cache_size is not None:
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def __getitem__(self, _id):
+        try:
+            return self._changed[_id]
+        except KeyError:
+            pass
+        with self._mutex:
+            try:
+                record = self._cache.pop(_id)
+            except KeyError:
+                if _id in self._deleted or _id > self._last_stored:
+                    raise
+                pos = self.store.position(_id)
+                record = self.store.record(pos, self.fields,
+                                           self.default_values, self.factory)
+            self._cache_record(_id, record)
+        return record
+
+    def __setitem__(self, _id, record):
+        if _id > self._last_stored and _id not in self._changed:
+            self._inserted += 1
+        self._cache.pop(_id, None)
+        self._changed[_id] = record
+
+    def __delitem__(self, _id):
+        if _id not in self:
+            raise KeyError(_id)
+        self._cache.pop(_id, None)
+        self._changed.pop(_id, None)
+        if _id > self._last_stored:
+            self._inserted -= 1
+        else:
+            self._deleted.add(_id)
+
+    def __contains__(self, _id):
+        if _id in self._changed or _id in self._cache:
+            return True
+        if _id in self._deleted or _id > self._last_stored:
+            return False
+        try:
+            self.store.position(_id)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def __len__(self):
+        return self.store.length - len(self._deleted) + self._inserted
+
+    def __iter__(self):
+        deleted = self._deleted
+        for _id in self.store.ids:
+            if _id not in deleted:
+                yield _id
+        last_stored = self._last_stored
+        for _id in sorted(_id for _id in self._changed if _id > last_stored):
+            yield _id
+
+    def touch(self, record):
+        """Mark a record as changed : it is kept in memory until the next
+        commit"""
+        self[record["__id__"]] = record
+
+    def loaded(self):
+        """Returns the records currently in memory"""
+        with self._mutex:
+            return list(self._changed.values()) + list(self._cache.values())
+
+    def cache(self, records):
+        """Put records in the cache"""
+        with self._mutex:
+            for record in records:
+                self._cache_record(record["__id__"], record)
+
+    def add_field(self, field):
+        """Called when a field is added to the base. The value of the field
+        in the records in memory is set by the base"""
+        # a column with the same name may remain from a dropped field
+        self.store.columns.pop(field, None)
+
+    def drop_field(self, field):
+        """Called when a field is removed from the base"""
+        self.store.columns.pop(field, None)
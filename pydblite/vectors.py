@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+#
+# BSD licence
+#
+# NumPy arrays of the values of the numeric fields of a pydblite base
+#
+# The array of a field is built the first time a filter or a count needs
+# it, then kept up to date by the changes of the base. The expressions of
+# a filter on these fields are evaluated as operations on arrays of
+# booleans (masks) instead of a test on each record.
+#
+
+import operator
+import sys
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if sys.version_info[0] == 2:
+    int_types = (int, long)  # NOQA
+else:
+    int_types = (int,)
+
+# types of the values that can be stored in the arrays
+number_types = (bool, float) + int_types
+
+# Kinds of columns (numpy dtypes)
+BOOL = "bool"
+INT = "int64"
+FLOAT = "float64"
+
+# integers that can be stored exactly in a column of floats
+_MAX_FLOAT_INT = 2 ** 53
+
+_comparisons = {"=": operator.eq, "!=": operator.ne,
+                "<": operator.lt, "<=": operator.le,
+                ">": operator.gt, ">=": operator.ge}
+
+
+def _kind(values):
+    """Returns the kind of column able to store all the values, or None if
+    some values are not numbers. None values are stored as nulls"""
+    types = set(map(type, values))
+    types.discard(type(None))
+    if not types:
+        return None
+    if types == set([bool]):
+        return BOOL
+    if bool in types or not types.issubset(number_types):
+        return None
+    if float not in types:
+        return INT
+    if any(abs(v) > _MAX_FLOAT_INT for v in values
+           if type(v) in int_types):
+        return None
+    return FLOAT
+
+
+def _fits(kind, value):
+    """True if value can be stored in a column of kind"""
+    if value is None:
+        return True
+    _type = type(value)
+    if kind == BOOL:
+        return _type is bool
+    if _type in int_types:
+        if kind == INT:
+            return -2 ** 63 <= value < 2 ** 63
+        return abs(value) <= _MAX_FLOAT_INT
+    return kind == FLOAT and _type is float
+
+
+class _Column(object):
+    """Values of a field, in the order of the ids of :class:`Vectors`"""
+
+    def __init__(self, kind, values):
+        self.kind = kind
+        self.nulls = numpy.array([v is None for v in values], dtype=BOOL)
+        if self.nulls.any():
+            values = [0 if v is None else v for v in values]
+        # raises OverflowError if an integer is too large
+        self.values = numpy.array(values, dtype=kind)
+
+    def extend(self, values):
+        other = _Column(self.kind, values)
+        self.values = numpy.concatenate((self.values, other.values))
+        self.nulls = numpy.concatenate((self.nulls, other.nulls))
+
+
+class Vectors(object):
+    """NumPy arrays of the values of the numeric fields of a base, used
+    with ``vectorize=True`` (see :class:`Base <pydblite.pydblite._Base>`)
+
+    The ids of the records are stored in a sorted array, and the values of
+    each field in an array in the same order. Deleted records are marked in
+    the array alive until the arrays are rebuilt
+
+    The arrays are built by the methods that read the base, which can run
+    at the same time in several threads : they are built by one thread at
+    a time"""
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Remove all the arrays, they are rebuilt when they are needed"""
+        # sorted ids of the records, None until an array is built
+        self.ids = None
+        self.alive = None
+        self.dead = 0
+        # mapping between fields and _Column, or None for the fields
+        # whose values are not all numbers
+        self.columns = {}
+        # records inserted since the arrays were built
+        self._new = []
+
+    def _flush(self):
+        """Add the records inserted since the arrays were built"""
+        if not self._new:
+            return
+        new, self._new = self._new, []
+        ids = numpy.array([r["__id__"] for r in new], dtype=INT)
+        self.ids = numpy.concatenate((self.ids, ids))
+        self.alive = numpy.concatenate((self.alive,
+                                        numpy.ones(len(ids), dtype=BOOL)))
+        for (field, column) in list(self.columns.items()):
+            if column is None:
+                continue
+            values = [r[field] for r in new]
+            if all(_fits(column.kind, v) for v in values):
+                column.extend(values)
+            else:
+                del self.columns[field]
+
+    def column(self, field, records):
+        """Returns the :class:`_Column` of field, built from records if
+        needed, or None if the values of field are not all numbers"""
+        with self._mutex:
+            return self._column(field, records)
+
+    def _column(self, field, records):
+        if self.ids is not None:
+            self._flush()
+            if self.dead > len(self.ids) // 2:
+                # most records were deleted, rebuild the arrays
+                self.clear()
+        if self.ids is None:
+            if not len(records):
+                return None
+            self.ids = numpy.array(sorted(records), dtype=INT)
+            self.alive = numpy.ones(len(self.ids), dtype=BOOL)
+        if field not in self.columns:
+            if self.dead:
+                values = [records[_id][field] if alive else None
+                          for (_id, alive) in zip(self.ids.tolist(),
+                                                  self.alive.tolist())]
+            else:
+                values = [records[_id][field] for _id in self.ids.tolist()]
+            kind = _kind(values)
+            try:
+                column = None if kind is None else _Column(kind, values)
+            except OverflowError:
+                column = None
+            self.columns[field] = column
+        return self.columns[field]
+
+    def mask(self, field, op, value, records):
+        """Returns the array of booleans set for the records whose field
+        matches the expression "field op value", or None if the arrays can't
+        be used for this expression"""
+        if op not in _comparisons and op != "IN":
+            return None
+        if op == "IN":
+            values = list(value)
+            if not all(v is None or type(v) in number_types for v in values):
+                return None
+        elif value is not None and type(value) not in number_types:
+            return None
+        elif value is None and op not in ("=", "!="):
+            return None
+        column = self.column(field, records)
+        if column is None:
+            return None
+        nulls = column.nulls
+        try:
+            if op == "IN":
+                numbers = [v for v in values if v is not None]
+                mask = numpy.isin(column.values, numbers) & ~nulls
+                if len(numbers) < len(values):
+                    mask |= nulls
+            elif value is None:
+                mask = nulls.copy() if op == "=" else ~nulls
+            elif op == "!=":
+                mask = column.values != value
+                mask |= nulls
+            else:
+                mask = _comparisons[op](column.values, value)
+                mask &= ~nulls
+        except (OverflowError, TypeError):
+            return None
+        return mask
+
+    def ids_of(self, mask):
+        """Returns the sorted list of the ids of the records selected by
+        mask"""
+        return self.ids[mask & self.alive].tolist()
+
+    def count(self, mask):
+        """Returns the number of records selected by mask"""
+        return int(numpy.count_nonzero(mask & self.alive))
+
+    def counts(self, field, records, mask=None):
+        """Returns a dictionary mapping the values of field in the records
+        selected by mask (all the records if mask is None) to the number of
+        these records, or None if field has no array of integers or
+        booleans"""
+        column = self.column(field, records)
+        if column is None or column.kind == FLOAT:
+            return None
+        selected = self.alive if mask is None else mask & self.alive
+        values, counts = numpy.unique(column.values[selected & ~column.nulls],
+                                      return_counts=True)
+        result = dict(zip(values.tolist(), counts.tolist()))
+        nulls = int(numpy.count_nonzero(selected & column.nulls))
+        if nulls:
+            result[None] = nulls
+        return result
+
+    def insert(self, records):
+        """Called when records are inserted in the base"""
+        if self.ids is not None:
+            self._new.extend(records)
+
+    def delete(self, ids):
+        """Called when the records with the sorted list of ids are deleted"""
+        if self.ids is None:
+            return
+        self._flush()
+        self.alive[numpy.searchsorted(self.ids, ids)] = False
+        self.dead += len(ids)
+        self._retry()
+
+    def update(self, changes):
+        """Called when records are updated. changes is a list of (record,
+        values), where values maps fields to their new values"""
+        if self.ids is None:
+            return
+        self._flush()
+        fields = {}
+        for (record, values) in changes:
+            for (field, value) in values.items():
+                fields.setdefault(field, []).append((record["__id__"], value))
+        for (field, new_values) in fields.items():
+            if field not in self.columns:
+                continue
+            column = self.columns[field]
+            if column is None or not all(_fits(column.kind, v)
+                                         for (_, v) in new_values):
+                # built again when it is needed
+                del self.columns[field]
+                continue
+            ids = [_id for (_id, _) in new_values]
+            other = _Column(column.kind, [v for (_, v) in new_values])
+            positions = numpy.searchsorted(self.ids, ids)
+            column.values[positions] = other.values
+            column.nulls[positions] = other.nulls
+
+    def drop_field(self, field):
+        """Called when a field is removed from the base"""
+        self.columns.pop(field, None)
+
+    def _retry(self):
+        """Forget the fields whose values were not all numbers, the values
+        that prevented building their arrays may have been removed"""
+        for field in [f for (f, c) in self.columns.items() if c is None]:
+            del self.columns[field]
@@ -227,6 +227,22 @@ class Generic(object):
         self.assertEqual(len(self.filter_db("name").like("Test")), 7)
         self.assertEqual(len(self.filter_db("name").like("Test0")), 3)
 
+    def test_filter_startswith(self):
+        """Test prefix, case sensitive"""
+        self.setup_db_for_filter()
+        f = self.filter_db("name").startswith("Test")
+        self.assertEqual(str(f), "name GLOB 'Test*'")
+        self.assertEqual(len(f), 6)
+        self.assertEqual(len(self.filter_db("name").startswith("test")), 1)
+        self.assertEqual(len(self.filter_db("name").startswith("Test4")), 2)
+
+    def test_filter_regex(self):
+        """Test regular expression"""
+        self.setup_db_for_filter()
+        self.assertEqual(len(self.filter_db("name").regex("^Test[04]$")), 4)
+        self.assertEqual(len(self.filter_db("name").regex("[67]")), 2)
+        self.assertEqual(len(self.filter_db("name").regex("^t")), 1)
+
     def test_filter_and(self):
         """Test AND"""
         self.setup_db_for_filter()
@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+import glob
 import os
+import pickle
+import shutil
 import sys
+import threading
+import time
 import unittest
 
-from pydblite.pydblite import Base
+from pydblite import locks, parallel, storage, vectors
+from pydblite.locks import ReadWriteLock
+from pydblite.pydblite import Base, Record
 
 from .common_tests import Generic
 
@@ -20,6 +28,11 @@ class PyDbLiteTestCase(Generic, unittest.TestCase):
         self.filter_db = filter_db
 
     def tearDown(self):  # NOQA
+        for suffix in ("-journal", "-journal-old", ".lock"):
+            if os.path.isfile(test_db_name + suffix):
+                os.remove(test_db_name + suffix)
+        for path in glob.glob(test_db_name + ".columns-*"):
+            shutil.rmtree(path)
         if os.path.isfile(test_db_name):
             os.remove(test_db_name)
         elif os.path.isdir(test_db_name):
@@ -125,9 +138,1348 @@ class PyDbLiteTestCase(Generic, unittest.TestCase):
         self.assertEqual(res, None)
         self.assertEqual(len(db), 8)
 
+    def test_journal(self):
+        db = Base(test_db_name, journal=True)
+        db.create('unique_id', 'name', "active", mode="override")
+        db.create_index('name')
+        size = os.path.getsize(test_db_name)
+        for i in range(5):
+            db.insert(i, "name%s" % i, True)
+        db.commit()
+        # the base file is not rewritten, changes go to the journal
+        self.assertEqual(os.path.getsize(test_db_name), size)
+        self.assertTrue(os.path.isfile(db.journal_path))
+
+        db.update(db[1], name="updated")
+        db.delete(db[2])
+        db.add_field("age", default=3)
+        db.commit()
+        db.insert(unique_id=5)  # not committed
+
+        db = Base(test_db_name).open()
+        self.assertEqual(len(db), 4)
+        self.assertEqual(db.next_id, 5)
+        self.assertEqual(db[1]["name"], "updated")
+        self.assertEqual(db[1]["__version__"], 1)
+        self.assertFalse(2 in db)
+        self.assertEqual(db[0]["age"], 3)
+        self.assertEqual([r["__id__"] for r in db._name["updated"]], [1])
+
+        # compact() merges the journal into the base file
+        db.compact()
+        self.assertFalse(os.path.isfile(db.journal_path))
+        db = Base(test_db_name).open()
+        self.assertEqual(db[1]["name"], "updated")
+
+    def test_journal_update_filter(self):
+        db = Base(test_db_name, journal=True)
+        db.create('unique_id', 'name', "active", mode="override")
+        for i in range(4):
+            db.insert(i, "name%s" % i, i % 2 == 0)
+        db.commit()
+        db.update(db("active") == True, name="updated")  # NOQA
+        db.update((r for r in db if r["unique_id"] == 1), name="one")
+        db.commit()
+        db = Base(test_db_name).open()
+        self.assertEqual([r["name"] for r in db],
+                         ["updated", "one", "updated", "name3"])
+
+    def test_journal_truncated(self):
+        db = Base(test_db_name, journal=True)
+        db.create('unique_id', 'name', "active", mode="override")
+        db.insert(1, "one", True)
+        db.commit()
+        size = os.path.getsize(db.journal_path)
+        db.insert(2, "two", True)
+        db.commit()
+        # simulate a crash while the last change was written
+        with open(db.journal_path, "r+b") as out:
+            out.truncate(os.path.getsize(db.journal_path) - 2)
+
+        db = Base(test_db_name, journal=True).open()
+        self.assertEqual(len(db), 1)
+        self.assertEqual(os.path.getsize(db.journal_path), size)
+        db.insert(3, "three", True)
+        db.commit()
+        db = Base(test_db_name).open()
+        self.assertEqual([r["unique_id"] for r in db], [1, 3])
+
+    def test_journal_cleaned_with_lock(self):
+        db = Base(test_db_name, journal=True)
+        db.create('unique_id', 'name', "active", mode="override")
+        db.insert(1, "one", True)
+        db.commit()
+        size = os.path.getsize(db.journal_path)
+        db.insert(2, "two", True)
+        db.commit()
+        with open(db.journal_path, "r+b") as out:
+            out.truncate(os.path.getsize(db.journal_path) - 2)
+        lock = locks.FileLock(test_db_name + ".lock")
+        with lock.locked():
+            counter = lock.counter()
+        # the truncated change is dropped as a write of the base
+        other = Base(test_db_name, journal=True).open()
+        self.assertEqual(os.path.getsize(db.journal_path), size)
+        with lock.locked():
+            self.assertEqual(lock.counter(), counter + 1)
+        self.assertFalse(other.refresh())
+        other.insert(3, "three", True)
+        other.commit()
+        # the journal was removed by another process
+        stat = os.stat(db.journal_path)
+        os.remove(db.journal_path)
+        other._clean_journal(db.journal_path, None, stat)
+        with lock.locked():
+            self.assertEqual(lock.counter(), counter + 2)
+
+    def test_commit_background(self):
+        db = Base(test_db_name)
+        db.create('unique_id', 'name', "active", mode="override")
+        db.create_index('name')
+        for i in range(100):
+            db.insert(i, "name%s" % i, True)
+        db.commit(background=True)
+        # changes made after the snapshot is taken are not saved
+        db.update(db[0], name="updated")
+        db.insert(100, "name100", True)
+        db.wait_commit()
+        self.assertFalse(os.path.isfile(test_db_name + ".tmp"))
+
+        saved = Base(test_db_name).open()
+        self.assertEqual(len(saved), 100)
+        self.assertEqual(saved[0]["name"], "name0")
+        self.assertEqual(len(saved._name["name0"]), 1)
+
+    def test_commit_background_copy_on_write(self):
+        db = Base(test_db_name)
+        db.create('unique_id', 'name', "active", mode="override")
+        db.create_index('name')
+        db.create_index('active', kind="bitmap")
+        for i in range(10):
+            db.insert(i, "name%s" % (i % 2), True)
+        # the thread writes the file after the changes below
+        started, write = threading.Event(), db._write
+
+        def wait_write(*args):
+            started.wait()
+            return write(*args)
+
+        db._write = wait_write
+        record = db[0]
+        db.commit(background=True)
+        db.update(db[0], name="name1", active=False)
+        db.update(db[0], unique_id=-1)
+        db.delete(db[2])
+        db.insert(10, "name0", True)
+        started.set()
+        db.wait_commit()
+        # the records and the lists of ids shared with the snapshot are
+        # copied before they are changed
+        self.assertEqual(record["name"], "name0")
+        self.assertEqual(db[0]["name"], "name1")
+        self.assertEqual(db.indices["name"]["name0"], [4, 6, 8, 10])
+        self.assertEqual(db.indices["name"]["name1"], [0, 1, 3, 5, 7, 9])
+        self.assertEqual(db.indices["active"].ids(True), [1, 3, 4, 5, 6, 7, 8, 9, 10])
+
+        saved = Base(test_db_name).open()
+        self.assertEqual(len(saved), 10)
+        self.assertEqual(saved[0]["name"], "name0")
+        self.assertEqual(saved[0]["unique_id"], 0)
+        self.assertEqual(saved.indices["name"]["name0"], [0, 2, 4, 6, 8])
+        self.assertEqual(saved.indices["name"]["name1"], [1, 3, 5, 7, 9])
+        self.assertEqual(saved.indices["active"].ids(True), list(range(10)))
+        # changes made after the commit copy nothing
+        db.update(db[4], name="name4")
+        self.assertIs(db[5], db[5])
+        self.assertIsNone(db._snapshot)
+
+    def test_commit_background_add_field(self):
+        db = Base(test_db_name, journal=True,
+                  compact_records=self.filter_db.compact_records)
+        db.create('unique_id', 'name', mode="override")
+        for i in range(10):
+            db.insert(i, "name%s" % i)
+        db.commit()
+        # the thread writes the file after add_field() is called
+        started, write = threading.Event(), db._write
+
+        def wait_write(*args):
+            started.wait()
+            return write(*args)
+
+        db._write = wait_write
+        db.compact(background=True)
+        threading.Timer(0.1, started.set).start()
+        db.add_field("age", default=3)
+        db.drop_field("name")
+        db.wait_commit()
+        db = Base(test_db_name).open()
+        self.assertEqual(db.fields, ["unique_id", "age"])
+        self.assertEqual(db[9]["age"], 3)
+
+    def test_commit_background_journal(self):
+        db = Base(test_db_name, journal=True)
+        db.create('unique_id', 'name', "active", mode="override")
+        db.insert(1, "one", True)
+        db.commit()
+        db.compact(background=True)
+        db.insert(2, "two", True)
+        db.commit()
+        db.wait_commit()
+        self.assertFalse(os.path.isfile(db.journal_path + "-old"))
+        db = Base(test_db_name).open()
+        self.assertEqual([r["unique_id"] for r in db], [1, 2])
+
+    def test_autocommit(self):
+        db = Base(test_db_name, commit_every=3)
+        db.create('unique_id', 'name', "active", mode="override")
+        db.insert(1, "one", True)
+        db.insert(2, "two", True)
+        self.assertEqual(len(Base(test_db_name).open()), 0)
+        db.insert(3, "three", True)
+        db.wait_commit()
+        self.assertEqual(len(Base(test_db_name).open()), 3)
+
+    def test_columnar_storage(self):
+        db = Base(test_db_name, storage="columnar")
+        db.create('unique_id', 'name', "active", "size", "birth",
+                  mode="override")
+        db.create_index("name")
+        for i in range(20):
+            db.insert(i, u"nàme%s" % (i % 3), i % 2 == 0, i / 2.0,
+                      datetime.date(2000, 1, i + 1) if i % 5 else None)
+        db.commit()
+        self.assertEqual(len(glob.glob(test_db_name + ".columns-*")), 1)
+
+        db = Base(test_db_name).open()
+        self.assertEqual(db.storage, "columnar")
+        self.assertEqual(len(db), 20)
+        # records are read from the column files when they are accessed
+        self.assertEqual(len(db.records.loaded()), 0)
+        self.assertEqual(db[7], {"__id__": 7, "__version__": 0,
+                                 "unique_id": 7, "name": u"nàme1",
+                                 "active": False, "size": 3.5,
+                                 "birth": datetime.date(2000, 1, 8)})
+        self.assertEqual(db[10]["birth"], None)
+        self.assertEqual(len(db.records.loaded()), 2)
+        self.assertEqual(len(db._name[u"nàme2"]), 6)
+
+        db.update(db[1], name="updated")
+        db.delete(db[2])
+        db.insert(unique_id=20)
+        db.add_field("age", default=3)
+        self.assertEqual(len(db), 20)
+        self.assertFalse(2 in db)
+        self.assertEqual([r["unique_id"] for r in db][:3], [0, 1, 3])
+        db.commit()
+        self.assertEqual(len(glob.glob(test_db_name + ".columns-*")), 1)
+
+        db = Base(test_db_name).open()
+        self.assertEqual(len(db), 20)
+        self.assertEqual(db[1]["name"], "updated")
+        self.assertEqual(db[1]["__version__"], 1)
+        self.assertEqual(db[20]["unique_id"], 20)
+        self.assertEqual(db[5]["age"], 3)
+
+        # convert to a pickled base
+        db.storage = "pickle"
+        db.commit()
+        self.assertEqual(glob.glob(test_db_name + ".columns-*"), [])
+        db = Base(test_db_name).open()
+        self.assertEqual(type(db.records), dict)
+        self.assertEqual(db[1]["name"], "updated")
+
+    def test_columnar_storage_python2(self):
+        # Python 2 has no memoryview.cast()
+        storage.memoryview = object
+        try:
+            self.assertRaises(ValueError, Base, test_db_name,
+                              storage="columnar")
+        finally:
+            del storage.memoryview
+
+    def test_columnar_cache_size(self):
+        db = Base(test_db_name, storage="columnar")
+        db.create('unique_id', 'name', "active", mode="override")
+        db.create_index("active")
+        for i in range(50):
+            db.insert(i, "name%s" % i, i % 2 == 0)
+        db.commit()
+
+        db = Base(test_db_name, cache_size=10).open()
+        self.assertEqual(len(db._active[True]), 25)
+        self.assertEqual(len(db.records.loaded()), 10)
+        self.assertEqual(sum(1 for r in db), 50)
+        self.assertEqual(len(db.records.loaded()), 10)
+
+        # changed records stay in memory until the next commit
+        record = db[0]
+        for i in range(1, 20):
+            db[i]
+        db.update(record, name="updated")
+        db.insert(50, "name50", True)
+        for i in range(20, 40):
+            db[i]
+        self.assertEqual(len(db.records.loaded()), 12)
+        self.assertEqual(db[0]["name"], "updated")
+        self.assertEqual(db[50]["name"], "name50")
+        db.commit()
+        self.assertEqual(len(db.records.loaded()), 10)
+
+        db = Base(test_db_name, cache_size=10).open()
+        self.assertEqual(len(db), 51)
+        self.assertEqual(db[0]["name"], "updated")
+
+    def test_columnar_cache_update_evicted(self):
+        db = Base(test_db_name, storage="columnar")
+        db.create('name', 'x', mode="override")
+        db.create_index("name")
+        db.insert(name="a", x=0)
+        db.insert(name="a", x=1)
+        db.commit()
+
+        db = Base(test_db_name, cache_size=1).open()
+        record = db[0]
+        db[1]
+        # record was evicted from the cache, db[0] is a new object
+        db.update(db[0], name="b")
+        db.update(record, x=100)
+        self.assertEqual(db[0]["name"], "b")
+        self.assertEqual(db[0]["x"], 100)
+        self.assertEqual([r["__id__"] for r in db._name["a"]], [1])
+        self.assertEqual([r["__id__"] for r in db._name["b"]], [0])
+
+    def test_columnar_commit_unchanged(self):
+        db = Base(test_db_name, storage="columnar")
+        db.create('unique_id', 'name', "size", "birth", mode="override")
+        for i in range(50):
+            db.insert(i, u"nàme%s" % i if i % 7 else None, i / 2.0,
+                      datetime.date(2000, 1, i % 28 + 1))
+        db.commit()
+
+        db = Base(test_db_name).open()
+        expected = dict((r["__id__"], dict(r)) for r in db)
+        db = Base(test_db_name).open()
+        db.update(db[3], name=u"updated", size="large")
+        db.delete(db[4])
+        db.insert(unique_id=50)
+        db.add_field("age", default=3)
+        db.commit()
+        # the records that were not changed are copied from the column
+        # files without being read
+        self.assertEqual(len(db.records.loaded()), 2)
+        expected[3].update(name=u"updated", size="large", __version__=1)
+        del expected[4]
+        expected[50] = dict(db[50])
+        for record in expected.values():
+            record.setdefault("age", 3)
+
+        db = Base(test_db_name).open()
+        self.assertEqual(dict((r["__id__"], r) for r in db), expected)
+        columns = db.records.store.header.columns
+        self.assertEqual([kind for (_, kind, _) in columns],
+                         ["q", "s", "p", "p", "q"])
+
+    def test_compact_records(self):
+        db = Base(test_db_name, compact_records=True)
+        db.create('unique_id', 'name', ("tags", []), mode="override")
+        db.create_index("name")
+        db.insert(1, "one")
+        db.insert(unique_id=2, name="two", tags=["a"])
+        record = db[0]
+        self.assertTrue(isinstance(record, Record))
+        self.assertEqual(record, {"__id__": 0, "__version__": 0,
+                                  "unique_id": 1, "name": "one", "tags": []})
+        # mutable default values are not shared
+        record["tags"].append("b")
+        self.assertEqual(db[db.insert(3)]["tags"], [])
+        db.update(record, name="updated")
+        self.assertEqual(db(name="updated"), [record])
+        self.assertEqual(record["__version__"], 1)
+        db.add_field("age", default=5)
+        db.drop_field("tags")
+        self.assertEqual(dict(db[1].items()), {"__id__": 1, "__version__": 0,
+                                               "unique_id": 2, "name": "two",
+                                               "age": 5})
+        db.commit()
+
+        db = Base(test_db_name, compact_records=True).open()
+        self.assertEqual(db[0]["name"], "updated")
+        self.assertTrue(db[0]._layout is db[1]._layout is db._layout)
+        # open as dictionaries
+        db = Base(test_db_name).open()
+        self.assertEqual(type(db[1]), dict)
+        self.assertEqual(db[1]["age"], 5)
+
+    def test_ordered_index(self):
+        db = Base(test_db_name)
+        db.create('unique_id', 'name', "age", mode="override")
+        for i in range(20):
+            db.insert(i, "name%s" % i, (i * 7) % 20)
+        db.insert(20, "noage")
+        db.create_index("age", kind="ordered")
+        self.assertEqual(db._age.keys(), [None] + list(range(20)))
+        self.assertEqual([r["age"] for r in db._age.range(5, 8)],
+                         [5, 6, 7, 8])
+        self.assertEqual([r["age"] for r in db._age.range(17, None, False)],
+                         [18, 19])
+        self.assertEqual(db._age.range("a"), [])
+
+        # range operators are answered by the index
+        db.update(db(age=3)[0], age=30)
+        db.delete(db(age=4))
+        self.assertEqual(sorted(r["age"] for r in (db("age") > 15)),
+                         [16, 17, 18, 19, 30])
+        self.assertEqual(len(db("age") <= 4), 3)
+        f = (db("age") >= 2) & (db("age") < 6)
+        self.assertEqual(sorted(r["age"] for r in f), [2, 5])
+        db.commit()
+
+        db = Base(test_db_name).open()
+        self.assertEqual(db._age.keys()[-3:], [18, 19, 30])
+        self.assertEqual(len(db("age") > 15), 5)
+
+    def test_filter_uses_indices(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        for i in range(7):
+            db.update(db[i], unique_id=i)
+        db.create_index("name")
+        db.create_index("unique_id", kind="ordered")
+
+        class NoScan(dict):
+            def values(self):
+                raise AssertionError("all the records are read")
+
+        db.records = NoScan(db.records)
+        f = (db("name") == "Test4") | (db("name") == ["Test6", "Test7"])
+        self.assertEqual([r["unique_id"] for r in db(f.expression_group)],
+                         [3, 4, 5, 6])
+        f = (db("unique_id") > 1) & (db("unique_id") <= 4)
+        self.assertEqual([r["unique_id"] for r in f], [2, 3, 4])
+        # "active" is not indexed, it is tested on the records found with
+        # the index on "name"
+        f = (db("name") == "Test4") & (db("active") == True)  # noqa
+        self.assertEqual([r["unique_id"] for r in f], [3])
+        f = ((db("name") == "Test0") | (db("unique_id") >= 5)) & \
+            (db("unique_id") != 1)
+        self.assertEqual([r["unique_id"] for r in f], [0, 5, 6])
+        self.assertEqual(len(f), 3)
+
+        # OR with a field without index needs all the records
+        f = (db("name") == "Test4") | (db("active") == True)  # noqa
+        self.assertRaises(AssertionError, len, f)
+
+    def test_filter_scan_order(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        for i in range(7):
+            db.update(db[i], unique_id=i)
+        tested = []
+
+        class Spy(str):
+            def __ne__(self, other):
+                tested.append(other)
+                return str.__ne__(self, other)
+            __hash__ = str.__hash__
+
+        # the "=" expression is evaluated first, the "!=" expression only
+        # on the records it returns
+        f = (db("name") != Spy("Test0")) & (db("unique_id") == 4)
+        self.assertEqual([r["unique_id"] for r in f], [4])
+        self.assertEqual(tested, ["Test4"])
+        # the records selected by OR are sorted by __id__
+        f = (db("unique_id") == 6) | (db("name") == "Test4") | \
+            (db("unique_id") == 0)
+        self.assertEqual([r["unique_id"] for r in f], [0, 3, 4, 6])
+
+    def test_filter_compile(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        f1 = db("name") == "Test4"
+        f = (db("active") == True) & f1  # noqa
+        group = f.expression_group
+        test = group.compile()
+        self.assertTrue(group.compile() is test)
+        self.assertEqual([r["unique_id"] for r in db() if test(r)], [4])
+        # changing a sub-filter builds a new function
+        f1 == "Test0"
+        self.assertFalse(group.compile() is test)
+        self.assertEqual([r["unique_id"] for r in f], [1, 2])
+        f = db("name").like("TEST6") | (db("name") == ["Test4", "Test7"])
+        self.assertEqual([r["name"] for r in f],
+                         ["Test4", "Test4", "Test6", "Test7"])
+
+    def test_filter_lazy(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        f = db("active") == False  # noqa
+        records = iter(f)
+        self.assertFalse(isinstance(records, list))
+        self.assertEqual(next(records)["unique_id"], 5)
+        self.assertEqual(f.first()["unique_id"], 5)
+        self.assertEqual(len(f), 3)
+        f.offset(1).limit(1)
+        self.assertEqual([r["unique_id"] for r in f], [6])
+        self.assertEqual(len(f), 1)
+        f.limit(5)
+        self.assertEqual([r["unique_id"] for r in f], [6, 7])
+        self.assertEqual(len(f), 2)
+        self.assertEqual((db("name") == "Test9").first(), None)
+        # with an index
+        db.create_index("name")
+        f = (db("name") == "Test0").offset(1)
+        self.assertEqual(len(f), 1)
+        self.assertEqual([r["unique_id"] for r in f], [2])
+
+    def test_filter_delete_in_loop(self):
+        self.reset_status_values_for_filter()
+        db = self.filter_db
+
+        def delete_next(f):
+            # each record deletes the next one
+            for d in self.status:
+                db.insert(**d)
+            ids = []
+            for r in f:
+                ids.append(r["__id__"])
+                db.delete([n for n in db if n["__id__"] > r["__id__"]][:1])
+            db.delete(db)
+            return ids
+
+        self.assertEqual(delete_next(db.filter()), [0, 2, 4, 6])
+        self.assertEqual(delete_next((db("unique_id") > 2).order_by("name")),
+                         [10, 12, 9])
+        db.create_index("unique_id", kind="ordered")
+        self.assertEqual(delete_next(db("unique_id") > 4), [18, 20])
+        self.assertEqual(delete_next(db.filter().order_by("unique_id")),
+                         [21, 23, 25, 27])
+        # the records inserted in the loop are not returned
+        db.insert(unique_id=8)
+        for r in db.filter():
+            db.insert(unique_id=8)
+        self.assertEqual(len(db), 2)
+
+    def test_filter_order_by(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        f = (db("active") == True).order_by("name")  # noqa
+        self.assertEqual([r["unique_id"] for r in f], [1, 2, 4, 3])
+        f = db("unique_id").order_by("name", desc=True).limit(3)
+        self.assertEqual([r["unique_id"] for r in f], [3, 7, 6])
+        f.offset(2)
+        self.assertEqual([r["unique_id"] for r in f], [6, 4, 5])
+        self.assertRaises(ValueError, db("name").order_by, "age")
+        # walk an ordered index
+        db.create_index("name", kind="ordered")
+
+        class NoScan(dict):
+            def values(self):
+                raise AssertionError("all the records are read")
+
+        db.records = NoScan(db.records)
+        f = (db("active") == True).order_by("name")  # noqa
+        self.assertEqual([r["unique_id"] for r in f], [1, 2, 4, 3])
+        f = db("unique_id").order_by("name", desc=True).offset(2).limit(3)
+        self.assertEqual([r["unique_id"] for r in f], [6, 4, 5])
+
+    def test_aggregate(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        db.insert(unique_id=None, name="Test0", active=None)
+        result = db.aggregate("active", sum="unique_id", min="name",
+                              max="unique_id", avg="unique_id")
+        self.assertEqual(result, [
+            {"active": None, "count": 1, "sum(unique_id)": None,
+             "min(name)": "Test0", "max(unique_id)": None,
+             "avg(unique_id)": None},
+            {"active": False, "count": 3, "sum(unique_id)": 18,
+             "min(name)": "Test4", "max(unique_id)": 7,
+             "avg(unique_id)": 6.0},
+            {"active": True, "count": 4, "sum(unique_id)": 10,
+             "min(name)": "Test0", "max(unique_id)": 4,
+             "avg(unique_id)": 2.5}])
+        result = db.aggregate(["active", "name"], db_filter=db("name") ==
+                              ["Test0", "Test4"])
+        self.assertEqual([(r["active"], r["name"], r["count"])
+                          for r in result],
+                         [(None, "Test0", 1), (False, "Test4", 1),
+                          (True, "Test0", 2), (True, "Test4", 1)])
+        self.assertEqual(db.aggregate(max="unique_id", count=False),
+                         [{"max(unique_id)": 7}])
+        self.assertEqual(db.aggregate(db_filter=db("name") == "Test9"),
+                         [{"count": 0}])
+        self.assertRaises(ValueError, db.aggregate, "age")
+        self.assertRaises(TypeError, db.aggregate, "name", median="name")
+
+        # counts read in the index
+        db.create_index("name")
+
+        class NoScan(dict):
+            def values(self):
+                raise AssertionError("all the records are read")
+
+        db.records = NoScan(db.records)
+        self.assertEqual([(r["name"], r["count"])
+                          for r in db.aggregate("name")],
+                         [("Test0", 3), ("Test4", 2), ("Test6", 1),
+                          ("Test7", 1), ("test0", 1)])
+        f = db("name") == ["Test0", "Test7"]
+        self.assertEqual([(r["name"], r["count"])
+                          for r in db.aggregate("name", f)],
+                         [("Test0", 3), ("Test7", 1)])
+
+    def test_group_by(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        records = sorted(db(), key=lambda r: r["active"])
+        self.assertEqual(sorted(db.group_by("name", records)),
+                         [("Test0", 2), ("Test4", 2), ("Test6", 1),
+                          ("Test7", 1), ("test0", 1)])
+
+    def test_group_count_with_index(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        db.create_index("name")
+        db.create_index("active")
+
+        class NoScan(dict):
+            def values(self):
+                raise AssertionError("all the records are read")
+
+        db.records = NoScan(db.records)
+        self.assertEqual(sorted(db.get_group_count("name")),
+                         [("Test0", 2), ("Test4", 2), ("Test6", 1),
+                          ("Test7", 1), ("test0", 1)])
+        f = db("active") == True  # noqa
+        self.assertEqual(sorted(db.get_group_count("name", f)),
+                         [("Test0", 2), ("Test4", 1), ("test0", 1)])
+        self.assertEqual(db.get_unique_ids("name", f),
+                         set(["Test0", "Test4", "test0"]))
+        self.assertEqual(db.get_unique_ids("active"), set([True, False]))
+        f = db("name") == "Test9"
+        self.assertEqual(db.get_group_count("active", f), [])
+        self.assertEqual(db.get_unique_ids("active", f), set())
+
+    def test_group_count_expression_group(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        f = (db("active") == True) & (db("name") != "Test4")  # noqa
+        group = f.expression_group
+        expected = [("Test0", 2), ("test0", 1)]
+        for index in [None, "name", "bitmap"]:
+            if index == "bitmap":
+                db.delete_index("name")
+                db.create_index("name", "active", kind="bitmap")
+            elif index is not None:
+                db.create_index(index)
+            for db_filter in [f, group]:
+                self.assertEqual(sorted(db.get_group_count("name", db_filter)),
+                                 expected)
+                self.assertEqual(db.get_unique_ids("name", db_filter),
+                                 set(["Test0", "test0"]))
+                self.assertEqual(
+                    [(g["name"], g["count"])
+                     for g in db.aggregate("name", db_filter)], expected)
+
+    def test_composite_index(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        db.create_index(("name", "active"))
+        self.assertEqual(db.indices[("name", "active")][("Test4", False)],
+                         [4])
+        self.assertEqual([r["unique_id"] for r in
+                          db._name_active[("Test0", True)]], [1, 2])
+        db.update(db[3], active=False)
+        db.insert(unique_id=8, name="Test0", active=False)
+
+        class NoScan(dict):
+            def values(self):
+                raise AssertionError("all the records are read")
+
+        db.records = NoScan(db.records)
+        self.assertEqual([r["unique_id"] for r in
+                          db(name="Test4", active=False)], [4, 5])
+        self.assertEqual(sorted(r["unique_id"] for r in
+                                db(active=True, name="Test0")), [1, 2])
+        # first field only
+        self.assertEqual(sorted(r["unique_id"] for r in db(name="Test0")),
+                         [1, 2, 8])
+        self.assertEqual(
+            [r["unique_id"] for r in db(name="Test0", unique_id=8)], [8])
+        f = (db("active") == False) & (db("name") == "Test4") & \
+            (db("unique_id") != 4)  # noqa
+        self.assertEqual([r["unique_id"] for r in f], [5])
+        f = db("name") == ["Test0", "Test6"]
+        self.assertEqual([r["unique_id"] for r in f], [1, 2, 6, 8])
+        self.assertEqual([(r["name"], r["active"], r["count"]) for r in
+                          db.aggregate(["name", "active"],
+                                       db_filter=db("name") == "Test0")],
+                         [("Test0", False, 1), ("Test0", True, 2)])
+        db.delete(db[7])
+        self.assertEqual(db.indices[("name", "active")].ids(("Test0", False)),
+                         [])
+        db.records = dict(db.records)
+        db.drop_field("active")
+        self.assertEqual(db.indices, {})
+
+    def test_composite_index_ordered(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        db.create_index(["active", "unique_id"], kind="ordered")
+        self.assertEqual(db._active_unique_id.keys()[:3],
+                         [(False, 5), (False, 6), (False, 7)])
+        self.assertEqual(sorted(r["unique_id"] for r in db(active=True)),
+                         [1, 2, 3, 4])
+        self.assertEqual([r["unique_id"] for r in db._active_unique_id.range(
+            (True, 2), (True, 3))], [2, 3])
+        db.delete_index(["active", "unique_id"])
+        self.assertEqual(db.indices, {})
+
+    def test_unique_index(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        self.assertRaises(ValueError, db.create_index, "name", unique=True)
+        self.assertEqual(db.indices, {})
+        db.create_index("unique_id", unique=True)
+        self.assertEqual(db.indices["unique_id"][3], 2)
+        self.assertEqual(db.get_by("unique_id", 3)["name"], "test0")
+        self.assertEqual(db.get_by("unique_id", 9), None)
+        self.assertRaises(ValueError, db.get_by, "name", "Test0")
+        self.assertEqual([r["__id__"] for r in db._unique_id[4]], [3])
+        self.assertEqual([r["__id__"] for r in db(unique_id=4)], [3])
+        self.assertEqual(len((db("unique_id") == 2) |
+                             (db("unique_id") == 9)), 1)
+
+        self.assertRaises(ValueError, db.insert, unique_id=1, name="Test8")
+        self.assertRaises(ValueError, db.update, db[0], unique_id=2)
+        self.assertRaises(ValueError, db.update, [db[0], db[1]],
+                          unique_id=9)
+        self.assertEqual(len(db), 7)
+        self.assertEqual(db[0]["unique_id"], 1)
+        db.insert(unique_id=8, name="Test8")
+        self.assertEqual(db.get_by("unique_id", 8)["__id__"], 7)
+        db.update(db[0], unique_id=10)
+        db.update(db[1], unique_id=1)
+        db.update(db[0], unique_id=2)
+        db.update(db[0], name="Test1")
+        self.assertEqual(db.get_by("unique_id", 2)["name"], "Test1")
+        db.delete(db[1])
+        self.assertEqual(db.get_by("unique_id", 1), None)
+
+        db.create_index(("name", "active"), kind="ordered", unique=True)
+        self.assertEqual(db.get_by(("name", "active"), ("Test0", True)),
+                         None)
+        self.assertEqual(db.get_by(("name", "active"),
+                                   ("Test4", False))["unique_id"], 5)
+        self.assertEqual([r["unique_id"] for r in db._name_active.range(
+            ("Test6", False), ("Test8", None))], [6, 7, 8])
+
+    def test_update_where(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        db.create_index("active")
+        f = (db("name") == "Test4") | (db("name") == "Test6")
+        self.assertEqual(db.update_where(f, active=None), 3)
+        self.assertEqual(sorted(r["unique_id"] for r in db._active[None]),
+                         [4, 5, 6])
+        self.assertEqual([r["__version__"] for r in db], [0, 0, 0, 1, 1, 1, 0])
+        self.assertEqual(db.update_where(db("name") == "Test9", active=1), 0)
+        self.assertEqual(db.update_where(f.expression_group, name="Test5"), 3)
+        self.assertEqual(len(db(name="Test5")), 3)
+
+    def test_update_where_index_calls(self):
+        for kind in ["hash", "ordered", "bitmap"]:
+            db = Base(test_db_name, save_to_file=False)
+            db.create("status", "n", mode="override")
+            db.insert_many([{"status": ("new", "old")[i % 3 == 0], "n": i}
+                            for i in range(1000)])
+            db.update(db[3], status="done")
+            db.create_index("status", kind=kind)
+            index = db.indices["status"]
+            calls = []
+            for name in ["add", "remove", "add_many", "remove_many"]:
+                def method(value, ids, name=name, method=getattr(index, name)):
+                    calls.append(name)
+                    return method(value, ids)
+                setattr(index, name, method)
+            db.update_where(db("n") < 500, status="done")
+            # each value of the index is changed once
+            self.assertEqual(sorted(calls), ["add_many", "remove_many",
+                                             "remove_many"])
+            self.assertEqual(db._status["done"], db(status="done"))
+            self.assertEqual(len(db._status["done"]), 500)
+            self.assertEqual(len(db._status["new"]), 333)
+
+    def test_upsert(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        rows = [{"unique_id": 2, "name": "Test2"},
+                {"unique_id": 9, "name": "Test9"},
+                {"unique_id": 9, "active": True},
+                {"unique_id": 7, "active": True}]
+        self.assertEqual(db.upsert("unique_id", rows), (1, 2))
+        self.assertEqual(len(db), 8)
+        self.assertEqual(db[1]["name"], "Test2")
+        self.assertEqual(db[1]["__version__"], 1)
+        self.assertEqual(db[6]["active"], True)
+        self.assertEqual(db[7]["name"], "Test9")
+        self.assertEqual(db[7]["active"], True)
+        # with a unique index on several fields
+        db.create_index(["name", "active"], unique=False)
+        db.delete(db[2])
+        db.create_index(["unique_id", "name"], unique=True)
+        rows = [{"unique_id": 9, "name": "Test9", "active": False},
+                {"unique_id": 9, "name": "Test8"}]
+        self.assertEqual(db.upsert(["unique_id", "name"], rows), (1, 1))
+        self.assertEqual(db.get_by(("unique_id", "name"),
+                                   (9, "Test9"))["active"], False)
+        self.assertEqual(db._name_active[("Test9", False)][0]["__id__"], 7)
+        self.assertEqual(db.get_by(("unique_id", "name"),
+                                   (9, "Test8"))["__id__"], 8)
+        self.assertRaises(NameError, db.upsert, "age", rows)
+        self.assertRaises(NameError, db.upsert, "name", [{"age": 3}])
+
+    def test_insert_many(self):
+        db = self.filter_db
+        db.create_index("name")
+        db.create_index("unique_id", unique=True)
+        db.insert(unique_id=0, name="Test1")
+        self.assertEqual(db.insert_many([]), None)
+        rows = [{"unique_id": 1, "name": "Test1"},
+                [2, "Test2", True],
+                {"unique_id": 3, "name": "Test1", "active": False}]
+        self.assertEqual(db.insert_many(rows), 3)
+        self.assertEqual(db.next_id, 4)
+        self.assertEqual(db[2]["active"], True)
+        self.assertEqual(db[1]["active"], None)
+        self.assertEqual(db[3]["__version__"], 0)
+        self.assertEqual(db.indices["name"]["Test1"], [0, 1, 3])
+        self.assertEqual(db.get_by("unique_id", 2)["__id__"], 2)
+        # nothing is inserted if a row is invalid
+        self.assertRaises(NameError, db.insert_many, [{"unique_id": 4},
+                                                      {"age": 3}])
+        self.assertRaises(ValueError, db.insert_many, [{"unique_id": 4},
+                                                       {"unique_id": 4}])
+        self.assertEqual(len(db), 4)
+        self.assertEqual(db.next_id, 4)
+
+    def test_insert_many_journal(self):
+        db = Base(test_db_name, journal=True)
+        db.create('unique_id', 'name', "active", mode="override")
+        db.insert_many([(i, "name%s" % i) for i in range(5)])
+        db.commit()
+        db = Base(test_db_name).open()
+        self.assertEqual(len(db), 5)
+        self.assertEqual(db[4]["name"], "name4")
+
+    def test_delete_many(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        db.create_index("active")
+        db.create_index("name", unique=False)
+        self.assertRaises(IndexError, db.delete, [db[0], db[0]])
+        self.assertEqual(db.delete([db[0], db[1], db[5]]), 3)
+        self.assertEqual(db.indices["active"][True], [2, 3])
+        self.assertEqual(db.indices["active"][False], [4, 6])
+        self.assertFalse("Test0" in db.indices["name"])
+        self.assertRaises(IndexError, db.delete, [db[2], {"__id__": 1}])
+        self.assertEqual(len(db), 4)
+
+    def test_delete_where(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        db.create_index("name")
+        self.assertEqual(db.delete_where(db("name") == "Test4"), 2)
+        self.assertEqual([r["unique_id"] for r in db], [1, 2, 3, 6, 7])
+        self.assertFalse("Test4" in db.indices["name"])
+        f = (db("active") == True) & (db("unique_id") > 1)  # noqa
+        self.assertEqual(db.delete_where(f.expression_group), 2)
+        self.assertEqual([r["unique_id"] for r in db], [1, 6, 7])
+        f = db("unique_id").order_by("unique_id", desc=True).limit(1)
+        self.assertEqual(db.delete_where(f), 1)
+        self.assertEqual(db.delete_where(db("name") == "Test9"), 0)
+        self.assertEqual(db.delete_where(db.filter()), 2)
+        self.assertEqual(len(db), 0)
+        self.assertEqual(db.indices["name"], {})
+
+    def test_bitmap_index(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        db.create_index("active", "name", kind="bitmap")
+        self.assertEqual(db.indices["active"].ids(True), [0, 1, 2, 3])
+        self.assertEqual([r["unique_id"] for r in db._name["Test4"]], [4, 5])
+        db.update(db[0], active=False)
+        db.insert(unique_id=8, name="Test4", active=True)
+        db.delete(db[5])
+        self.assertEqual(db.indices["active"].ids(False), [0, 4, 6])
+        self.assertEqual(db.indices["name"].ids("Test6"), [])
+
+        class NoScan(dict):
+            def values(self):
+                raise AssertionError("all the records are read")
+
+        db.records = NoScan(db.records)
+        f = (db("active") == True) & ((db("name") == "Test4") |  # noqa
+                                      (db("name") != "Test0"))
+        self.assertEqual(f.expression_group.bitmap(db), 0b10001100)
+        self.assertEqual([r["unique_id"] for r in f], [3, 4, 8])
+        self.assertEqual(len(f), 3)
+        self.assertEqual([r["unique_id"] for r in
+                          db(active=False, name="Test0")], [1])
+        self.assertEqual(sorted(db.get_group_count("name", f)),
+                         [("Test4", 2), ("test0", 1)])
+
+        index = pickle.loads(pickle.dumps(db.indices["active"]))
+        self.assertEqual(index.ids(False), [0, 4, 6])
+
+    def test_text_index(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        db.update(db[6], name="Homer Simpson")
+        db.create_index("name", kind="text")
+        db.insert(unique_id=8, name="Marge Simpson", active=True)
+        db.insert(unique_id=9, name=None, active=True)
+
+        class NoScan(dict):
+            def values(self):
+                raise AssertionError("all the records are read")
+
+        db.records = NoScan(db.records)
+        self.assertEqual([r["unique_id"] for r in db("name").like("SIMPS")],
+                         [7, 8])
+        self.assertEqual([r["unique_id"] for r in db("name").like("st0")],
+                         [1, 2, 3])
+        self.assertEqual([r["unique_id"] for r in db("name").like("t4")],
+                         [4, 5])
+        self.assertEqual([r["unique_id"] for r in db("name").ilike("Test")],
+                         [1, 2, 4, 5, 6])
+        self.assertEqual(len(db("name").like("lisa")), 0)
+        f = db("name").like("simpson") & (db("active") == True)  # noqa
+        self.assertEqual([r["unique_id"] for r in f], [8])
+        self.assertEqual([r["unique_id"] for r in db._name.search(
+            "simpson MARGE")], [8])
+        self.assertEqual(db._name.search("simp"), [])
+        db.records = dict(db.records)
+        db.delete(db[7])
+        self.assertEqual(db._name.search("marge"), [])
+        index = pickle.loads(pickle.dumps(db.indices["name"]))
+        self.assertEqual(index.like_ids("SON"), [6])
+
+    def test_startswith_regex_index(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+        db.insert(unique_id=8, name=None, active=True)
+        db.insert(unique_id=9, name=12, active=True)
+
+        class NoScan(dict):
+            def values(self):
+                raise AssertionError("all the records are read")
+
+        for kind in ("ordered", "hash", "text"):
+            db.create_index("name", kind=kind)
+            db.records = NoScan(db.records)
+            self.assertEqual(
+                [r["unique_id"] for r in db("name").startswith("Test")],
+                [1, 2, 4, 5, 6, 7])
+            self.assertEqual(
+                [r["unique_id"] for r in db("name").startswith("Test4")],
+                [4, 5])
+            self.assertEqual(len(db("name").startswith("Test9")), 0)
+            self.assertEqual(
+                [r["unique_id"] for r in db("name").regex("^[tT]est[04]$")],
+                [1, 2, 3, 4, 5])
+            f = db("name").startswith("Test") & (db("active") == True)  # noqa
+            self.assertEqual([r["unique_id"] for r in f], [1, 2, 4])
+            db.records = dict(db.records)
+            db.delete_index("name")
+        self.assertEqual(len(db("name").regex("7$")), 1)
+
+    @unittest.skipIf(vectors.numpy is None, "NumPy is not installed")
+    def test_vectorize(self):
+        db = Base(test_db_name, save_to_file=False, vectorize=True,
+                  compact_records=self.filter_db.compact_records)
+        db.create("name", "age", "size", mode="override")
+        db.insert_many([("a%s" % i, i % 10, i * 0.5) for i in range(100)])
+        db.insert(name="b", age=None, size=1.5)
+
+        def ids(f):
+            return [r["__id__"] for r in f]
+
+        def expected(test):
+            return [_id for (_id, r) in sorted(db.records.items())
+                    if test(r)]
+
+        class NoScan(dict):
+            def values(self):
+                raise AssertionError("all the records are read")
+
+        db.records = NoScan(db.records)
+        self.assertEqual(ids(db("age") >= 5),
+                         [i for i in range(100) if i % 10 >= 5])
+        self.assertEqual(len(db("age") > 7), 20)
+        self.assertEqual(ids(db("age") == None), [100])  # noqa
+        self.assertEqual(len(db("age") != 3), 91)
+        f = (db("age") == [1, 2]) | (db("size") < 3)
+        self.assertEqual(ids(f), [0, 1, 2, 3, 4, 5, 11, 12, 21, 22, 31, 32,
+                                  41, 42, 51, 52, 61, 62, 71, 72, 81, 82, 91,
+                                  92, 100])
+        counts = dict(db.get_group_count("age"))
+        self.assertEqual(counts[None], 1)
+        self.assertEqual(counts[4], 10)
+        counts = dict((i, 1) for i in range(10))
+        counts[None] = 1
+        self.assertEqual(dict(db.get_group_count("age", db("size") < 5)),
+                         counts)
+        # the arrays follow the changes of the base
+        db.update(db[0], age=42)
+        db.delete(db[1])
+        db.insert(name="c", age=1, size=2.0)
+        self.assertEqual(ids(db("age") == 42), [0])
+        self.assertEqual(ids(db("age") == 1), [11, 21, 31, 41, 51, 61, 71,
+                                               81, 91, 101])
+        self.assertEqual(ids((db("age") == 1) & (db("size") <= 2)), [101])
+        # values that are not numbers are tested on each record
+        db.records = dict(db.records)
+        db.update(db[2], age="old")
+        self.assertEqual(ids(db("age") == 1), expected(
+            lambda r: r["age"] == 1))
+        self.assertEqual(ids(db("name") == "a3"), [3])
+
+    def test_parallel_scan(self):
+        self.setup_db_for_filter()
+        db = self.filter_db
+
+        def results():
+            f = (db("name") == "Test4") | (db("active") == False)  # noqa
+            return ([r["__id__"] for r in f],
+                    len(db("name").like("test0")),
+                    sorted(r["__id__"] for r in db(name="Test0")),
+                    db.aggregate(group_by="name", sum="unique_id",
+                                 min="unique_id", avg="unique_id"),
+                    db.aggregate(group_by="active", max="unique_id",
+                                 db_filter=db("unique_id") > 2),
+                    sorted(db.get_group_count("name",
+                                              db("active") == True)))  # noqa
+
+        expected = results()
+        min_records = parallel.MIN_RECORDS
+        parallel.MIN_RECORDS = 0
+        db.processes = 2
+        try:
+            pids = parallel.map_chunks(db.records, lambda r: os.getpid(), 2)
+            self.assertEqual(len(pids), 7)
+            self.assertNotIn(os.getpid(), pids)
+            self.assertEqual(results(), expected)
+
+            # concurrent scans of several threads, slow to start the workers
+            scans = {}
+            pool = parallel._pool
+
+            def slow_pool(processes):
+                time.sleep(0.05)
+                return pool(processes)
+
+            def scan(n):
+                records = dict((i, {"__id__": i, "n": n})
+                               for i in range(n, n + 20))
+                scans[n] = parallel.select(records,
+                                           lambda r: r["__id__"] % 2, 2)
+
+            threads = [threading.Thread(target=scan, args=(n,))
+                       for n in range(4)]
+            parallel._pool = slow_pool
+            try:
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            finally:
+                parallel._pool = pool
+            self.assertEqual(scans, dict((n, list(range(n | 1, n + 20, 2)))
+                                         for n in range(4)))
+        finally:
+            parallel.MIN_RECORDS = min_records
+
+    def test_thread_safe(self):
+        db = Base(test_db_name, save_to_file=False, thread_safe=True,
+                  compact_records=self.filter_db.compact_records)
+        db.create("name", "n", mode="override")
+        db.create_index("n")
+        errors = []
+
+        def write(k):
+            try:
+                for i in range(200):
+                    _id = db.insert(name="w%s" % k, n=i)
+                    if i % 2:
+                        db.delete(db[_id])
+                    else:
+                        db.update(db[_id], n=-i)
+            except Exception as exc:
+                errors.append(exc)
+
+        def read():
+            try:
+                for i in range(30):
+                    for r in db:
+                        r["n"]
+                    len(db("n") < 0)
+                    list(db("name") == "w1")
+                    db(name="w2")
+                    db.get_group_count("name")
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = ([threading.Thread(target=write, args=(k,))
+                    for k in range(4)] +
+                   [threading.Thread(target=read) for k in range(2)])
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(db), 400)
+        index = db.indices["n"]
+        self.assertEqual(sorted(_id for value in index
+                                for _id in index.ids(value)),
+                         sorted(r["__id__"] for r in db))
+        for value in index:
+            for _id in index.ids(value):
+                self.assertEqual(db[_id]["n"], value)
+
+        # iteration returns the records found when it starts, and update()
+        # doesn't change the records already returned
+        records = iter(db)
+        record = db[0]
+        db.update(record, name="new")
+        db.insert(name="x", n=1)
+        self.assertEqual(len(list(records)), 400)
+        self.assertNotEqual(record["name"], "new")
+        self.assertEqual(db[0]["name"], "new")
+        self.assertEqual(db[0]["__version__"], record["__version__"] + 1)
+
+    @unittest.skipIf(vectors.numpy is None, "NumPy is not installed")
+    def test_thread_safe_caches(self):
+        db = Base(test_db_name, storage="columnar")
+        db.create("name", "n", mode="override")
+        db.insert_many([("a%s" % i, i) for i in range(1000)])
+        db.commit()
+        db = Base(test_db_name, thread_safe=True, vectorize=True,
+                  cache_size=10).open()
+        self.assertEqual(len(db("n") < 0), 0)
+        errors = []
+
+        def read(k, size):
+            try:
+                for _id in range(k, 1000, 7):
+                    self.assertEqual(db[_id]["n"], _id)
+                self.assertEqual(len(db("n") < 0), size)
+                self.assertEqual(len(db.records.loaded()), size + 10)
+            except Exception as exc:
+                errors.append(exc)
+
+        # the readers change the cache of records, and add the records
+        # inserted before to the arrays
+        for i in range(5):
+            db.insert_many([("b", -1)] * 500)
+            threads = [threading.Thread(target=read, args=(k, len(db) - 1000))
+                       for k in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+
+    def test_thread_safe_update_old_record(self):
+        db = Base(test_db_name, save_to_file=False, thread_safe=True)
+        db.create("name", "n", mode="override")
+        db.create_index("name")
+        db.insert(name="a", n=0)
+        db.insert(name="a", n=1)
+        record = db[0]
+        db.update(record, name="b")
+        # record is the version before the update
+        db.update(record, n=100)
+        self.assertEqual(db[0]["name"], "b")
+        self.assertEqual(db[0]["n"], 100)
+        self.assertEqual(db[0]["__version__"], 2)
+        db.update(record, name="c")
+        self.assertEqual([r["__id__"] for r in db._name["a"]], [1])
+        self.assertEqual(db._name["b"], [])
+        self.assertEqual([r["__id__"] for r in db._name["c"]], [0])
+
+    def test_read_write_lock(self):
+        lock = ReadWriteLock()
+        events = []
+
+        def write():
+            lock.acquire_write()
+            events.append("write")
+            lock.release_write()
+
+        lock.acquire_read()
+        lock.acquire_read()
+        thread = threading.Thread(target=write)
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(events, [])
+        # a reader can't wait for the write lock
+        self.assertRaises(RuntimeError, lock.acquire_write)
+        lock.release_read()
+        lock.release_read()
+        thread.join()
+        self.assertEqual(events, ["write"])
+        # the writer can write again, and read
+        lock.acquire_write()
+        lock.acquire_write()
+        lock.acquire_read()
+        lock.release_read()
+        lock.release_write()
+        lock.release_write()
+
+    def test_refresh(self):
+        db = Base(test_db_name, compact_records=self.filter_db.compact_records)
+        db.create("name", "age", mode="override")
+        db.insert(name="homer", age=40)
+        db.commit()
+        other = Base(test_db_name).open()
+        self.assertFalse(other.refresh())
+        db.insert(name="marge", age=38)
+        db.commit()
+        self.assertTrue(other.refresh())
+        self.assertEqual(len(other), 2)
+        self.assertFalse(other.refresh())
+        other.insert(name="bart", age=10)
+        other.commit()
+        # the base was changed by other since db read it
+        db.insert(name="lisa", age=8)
+        self.assertRaises(IOError, db.commit)
+        self.assertTrue(db.refresh())
+        self.assertEqual(sorted(r["name"] for r in db),
+                         ["bart", "homer", "marge"])
+        db.insert(name="lisa", age=8)
+        db.commit()
+        self.assertEqual(len(Base(test_db_name).open()), 4)
+
+    def test_refresh_background_commit(self):
+        db = Base(test_db_name)
+        db.create("name", "age", mode="override")
+        db.insert(name="homer", age=40)
+        db.commit()
+        other = Base(test_db_name).open()
+        # the background commit writes the file after other commits
+        started, write = threading.Event(), db._write
+
+        def wait_write(*args):
+            started.wait()
+            return write(*args)
+
+        db._write = wait_write
+        db.insert(name="marge", age=38)
+        db.commit(background=True)
+        other.insert(name="bart", age=10)
+        other.commit()
+        started.set()
+        self.assertRaises(IOError, db.wait_commit)
+        self.assertEqual(sorted(r["name"] for r in Base(test_db_name).open()),
+                         ["bart", "homer"])
+
+    def test_refresh_journal(self):
+        db = Base(test_db_name, journal=True)
+        db.create("name", "age", mode="override")
+        db.insert(name="homer", age=40)
+        db.commit()
+        other = Base(test_db_name, journal=True).open()
+        records = other.records
+        db.insert(name="marge", age=38)
+        db.update(db(name="homer")[0], age=41)
+        db.commit()
+        self.assertTrue(other.refresh())
+        # only the changes appended to the journal are applied
+        self.assertIs(other.records, records)
+        self.assertEqual(sorted((r["name"], r["age"]) for r in other),
+                         [("homer", 41), ("marge", 38)])
+        db.delete(db(name="marge"))
+        db.commit()
+        self.assertTrue(other.refresh())
+        self.assertIs(other.records, records)
+        self.assertEqual(len(other), 1)
+        db.compact()
+        self.assertTrue(other.refresh())
+        self.assertIsNot(other.records, records)
+        self.assertEqual(len(other), 1)
+        other.insert(name="bart", age=10)
+        other.commit()
+        self.assertEqual(len(Base(test_db_name).open()), 2)
+
+    @unittest.skipIf(locks.fcntl is None, "fcntl is not available")
+    def test_file_lock(self):
+        lock = locks.FileLock(test_db_name + ".lock")
+        held, times = threading.Event(), []
+
+        def write():
+            with lock.locked(exclusive=True):
+                lock.increment()
+                held.set()
+                time.sleep(0.1)
+                times.append(time.time())
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        held.wait()
+        # each thread has its own lock : this one waits for the writer
+        with lock.locked():
+            times.append(time.time())
+            self.assertEqual(lock.counter(), 1)
+            with lock.locked(exclusive=True):
+                self.assertEqual(lock.increment(), 2)
+        thread.join()
+        self.assertTrue(times[0] <= times[1])
+
+    def test_file_lock_not_created(self):
+        lock = locks.FileLock(os.path.join(test_db_name, "base.lock"))
+        # read without a lock
+        with lock.locked():
+            self.assertEqual(lock.counter(), 0)
+        self.assertRaises(IOError, lock.acquire, True)
+
+    @unittest.skipIf(not hasattr(os, "geteuid") or os.geteuid() == 0,
+                     "the permissions of a directory don't apply to root")
+    def test_read_only_directory(self):
+        os.mkdir(test_db_name)
+        path = os.path.join(test_db_name, "base.pdl")
+        db = Base(path)
+        db.create("name", "age")
+        db.insert(name="homer", age=23)
+        db.commit()
+        os.remove(path + ".lock")
+        os.chmod(test_db_name, 0o555)
+        try:
+            db = Base(path).open()
+            self.assertEqual([r["name"] for r in db], ["homer"])
+            self.assertFalse(os.path.exists(path + ".lock"))
+            db.refresh()
+            db.insert(name="marge", age=36)
+            self.assertRaises(IOError, db.commit)
+        finally:
+            os.chmod(test_db_name, 0o755)
+            shutil.rmtree(test_db_name)
+
+
+class PyDbLiteCompactRecordsTestCase(PyDbLiteTestCase):
+
+    def setUp(self):  # NOQA
+        self.first_record_id = 0
+        filter_db = Base(test_db_name, save_to_file=False,
+                         compact_records=True)
+        filter_db.create('unique_id', 'name', "active", mode="override")
+        self.filter_db = filter_db
+
 
 if __name__ == "__main__":
     sys.path.insert(0, os.getcwd())
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PyDbLiteTestCase))
+    suite.addTest(unittest.makeSuite(PyDbLiteCompactRecordsTestCase))
     unittest.TextTestRunner().run(suite)